@@ -0,0 +1,56 @@
+# Micro-benchmark for the /api/mt4data decode path: the old regex/json/loop
+# pipeline against clean_payload + json_loads + decode_account.
+#   python benchmarks/ingest_decode.py [iterations]
+import json
+import logging
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("MT4_SERVER_ROLE", "cli")
+
+import mt4_online_server as server  # noqa: E402
+
+logging.getLogger("mt4_online_server").setLevel(logging.INFO)
+
+SAMPLE = {field: 1234.56 for field in server.ACCOUNT_FIELDS}
+SAMPLE.update({"broker": "Raw Trading Ltd", "account_number": 5012345, "open_charts": 12,
+               "empty_charts": 1, "open_trades": 7, "autotrading": "true"})
+PAYLOAD = json.dumps(SAMPLE).encode() + b"\x00\r\n"
+
+def legacy_decode(raw_data):
+    decoded = raw_data.decode("utf-8", errors="replace")
+    cleaned = re.sub(r'[^\x20-\x7E]', '', decoded).strip()
+    server.logger.debug(f"Raw Request Data: {cleaned}")
+    json_data = json.loads(cleaned)
+    for field in server.ACCOUNT_FIELDS:
+        if field not in json_data:
+            return None
+    json_data["autotrading"] = json_data["autotrading"] == "true" or json_data["autotrading"] == True
+    return json_data
+
+def fast_decode(raw_data):
+    account, error = server.decode_account(server.json_loads(server.clean_payload(raw_data)))
+    return account
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    assert fast_decode(PAYLOAD)["autotrading"] is True
+    results = {}
+    for name, decode in (("legacy", legacy_decode), ("fast", fast_decode)):
+        seconds = min(timeit.repeat(lambda: decode(PAYLOAD), number=iterations, repeat=5))
+        results[name] = seconds / iterations * 1e6
+    print(json.dumps({
+        "json_backend": "orjson" if server.orjson is not None else "json",
+        "payload_bytes": len(PAYLOAD),
+        "iterations": iterations,
+        "legacy_us_per_request": round(results["legacy"], 2),
+        "fast_us_per_request": round(results["fast"], 2),
+        "saved_us_per_request": round(results["legacy"] - results["fast"], 2),
+        "speedup": round(results["legacy"] / results["fast"], 2)
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
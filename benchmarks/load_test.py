@@ -0,0 +1,280 @@
+# Load test: N simulated MT4 terminals posting /api/mt4data, M dashboards polling the read APIs and
+# holding Socket.IO subscriptions. Results are written as JSON so runs can be compared across commits.
+#
+#   python benchmarks/load_test.py --database-url postgresql://localhost/mt4_bench \
+#       --terminals 200 --rate 1 --dashboards 20 --duration 60 --output results/$(git rev-parse --short HEAD).json
+#
+# Without --url the database is migrated and the app started under gunicorn against --database-url
+# (use a throwaway local database). Pass --url to measure an already running server instead.
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import requests
+import socketio
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+FLOAT_FIELDS = [
+    "balance", "equity", "margin_used", "free_margin", "margin_percent", "profit_loss",
+    "realized_pl_daily", "realized_pl_weekly", "realized_pl_monthly", "realized_pl_yearly",
+    "realized_pl_alltime", "deposits_alltime", "withdrawals_alltime", "holding_fee_daily",
+    "holding_fee_weekly", "holding_fee_monthly", "holding_fee_yearly", "holding_fee_alltime",
+    "swap_daily", "swap_weekly", "swap_monthly", "swap_yearly", "swap_alltime", "deposits_daily",
+    "deposits_weekly", "deposits_monthly", "deposits_yearly", "withdrawals_daily", "withdrawals_weekly",
+    "withdrawals_monthly", "withdrawals_yearly", "prev_day_pl", "prev_day_holding_fee"
+]
+BROKERS = ["Raw Trading Ltd", "Swissquote", "XTB International"]
+DASHBOARD_PATHS = ["/api/accounts", "/api/quickstats", "/api/analytics"]
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3)
+    }
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.sent = {}  # profit_loss nonce -> send time, matched against account_update emits
+        self.fanout = []
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def mark_sent(self, nonce, at):
+        with self._lock:
+            self.sent[nonce] = at
+
+    def mark_received(self, nonce, at):
+        with self._lock:
+            sent = self.sent.pop(nonce, None)
+            if sent is not None:
+                self.fanout.append(at - sent)
+
+def terminal_payload(account_number, broker, nonce):
+    payload = {field: round(random.uniform(-5000, 50000), 2) for field in FLOAT_FIELDS}
+    payload.update({
+        "broker": broker,
+        "account_number": account_number,
+        "profit_loss": nonce,
+        "open_charts": random.randint(0, 20),
+        "empty_charts": random.randint(0, 3),
+        "open_trades": random.randint(0, 40),
+        "autotrading": random.choice(["true", "false"])
+    })
+    return payload
+
+def run_terminal(base_url, index, rate, stop, stats):
+    session = requests.Session()
+    account_number = 9_000_000 + index
+    broker = BROKERS[index % len(BROKERS)]
+    interval = 1.0 / rate
+    next_at = time.monotonic() + random.uniform(0, interval)
+    sequence = 0
+    while not stop.is_set():
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            stop.wait(delay)
+            continue
+        next_at += interval
+        sequence += 1
+        nonce = float(f"{index}.{sequence:06d}")
+        body = json.dumps(terminal_payload(account_number, broker, nonce))
+        started = time.perf_counter()
+        stats.mark_sent(nonce, time.monotonic())
+        try:
+            response = session.post(f"{base_url}/api/mt4data", data=body, timeout=30)
+            stats.record("POST /api/mt4data", time.perf_counter() - started, response.status_code == 200)
+        except requests.RequestException:
+            stats.record("POST /api/mt4data", time.perf_counter() - started, False)
+
+def on_account_update(stats, data):
+    received = time.monotonic()
+    accounts = data.get("accounts") if isinstance(data, dict) and "accounts" in data else [data]
+    for account in accounts or []:
+        if isinstance(account, dict) and "profit_loss" in account:
+            stats.mark_received(account["profit_loss"], received)
+
+def run_dashboard(base_url, poll_interval, stop, stats, clients):
+    client = socketio.Client(reconnection=False)
+    client.on("account_update", lambda data: on_account_update(stats, data))
+    try:
+        # Websocket only: with several workers and no sticky balancer a long-poll session hops workers and breaks
+        client.connect(base_url, transports=["websocket"], wait_timeout=10)
+        clients.append(client)
+    except Exception as e:
+        print(f"dashboard socket failed: {e}", file=sys.stderr)
+    session = requests.Session()
+    while not stop.is_set():
+        for path in DASHBOARD_PATHS:
+            started = time.perf_counter()
+            try:
+                response = session.get(f"{base_url}{path}", timeout=30)
+                stats.record(f"GET {path}", time.perf_counter() - started, response.status_code == 200)
+            except requests.RequestException:
+                stats.record(f"GET {path}", time.perf_counter() - started, False)
+        stop.wait(poll_interval)
+
+def scrape_query_count(base_url):
+    try:
+        text = requests.get(f"{base_url}/metrics", timeout=10).text
+    except requests.RequestException:
+        return None
+    return sum(float(value) for value in re.findall(r"^mt4_db_query_seconds_count\{.*\} (\S+)$", text, re.M))
+
+def transaction_count(database_url, sslmode):
+    # Commits + rollbacks across every worker, unlike /metrics which only covers the worker that answers
+    try:
+        with psycopg2.connect(database_url, sslmode=sslmode) as conn, conn.cursor() as cur:
+            cur.execute("SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database();")
+            return cur.fetchone()[0]
+    except psycopg2.Error:
+        return None
+
+def start_server(args):
+    env = dict(os.environ, DATABASE_URL=args.database_url, DB_SSLMODE=args.sslmode, PORT=str(args.port), LOG_LEVEL="WARNING",
+               SOCKETIO_TRANSPORTS="websocket")
+    module = "mt4_online_async:app" if args.worker_class == "eventlet" else "mt4_online_server:app"
+    command = ["gunicorn", "--worker-class", args.worker_class, "--workers", str(args.workers),
+               "--bind", f"127.0.0.1:{args.port}", "--log-level", "warning", module]
+    if args.worker_class == "eventlet":
+        command[1:1] = ["--worker-connections", "2000"]
+    elif args.threads > 1:
+        # gunicorn runs sync with --threads as gthread; each open dashboard socket holds one thread
+        command[1:1] = ["--threads", str(args.threads)]
+    subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True)
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/api/health", timeout=2).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise SystemExit("server did not become healthy within 60s")
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of MT4 terminals and dashboards")
+    parser.add_argument("--url", help="measure a running server instead of starting one")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", "postgresql://localhost/mt4_bench"))
+    parser.add_argument("--sslmode", default="disable")
+    parser.add_argument("--worker-class", default="eventlet", choices=["eventlet", "sync"])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1, help="threads per sync worker")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--terminals", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1.0, help="posts per second per terminal")
+    parser.add_argument("--dashboards", type=int, default=10)
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds of traffic excluded from the results")
+    parser.add_argument("--output", default="benchmarks/results.json")
+    args = parser.parse_args()
+
+    process = None
+    base_url = args.url
+    if not base_url:
+        process, base_url = start_server(args)
+    stats = Stats()
+    stop = threading.Event()
+    clients = []
+    threads = [threading.Thread(target=run_terminal, args=(base_url, index, args.rate, stop, stats), daemon=True)
+               for index in range(args.terminals)]
+    threads += [threading.Thread(target=run_dashboard, args=(base_url, args.poll_interval, stop, stats, clients), daemon=True)
+                for _ in range(args.dashboards)]
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        # Restart the sample window after warm-up; in-flight nonces stay so their emits still match
+        with stats._lock:
+            stats.latencies, stats.errors, stats.fanout = {}, {}, []
+        queries_before = scrape_query_count(base_url)
+        transactions_before = transaction_count(args.database_url, args.sslmode)
+        started = time.monotonic()
+        time.sleep(args.duration)
+        elapsed = time.monotonic() - started
+        queries_after = scrape_query_count(base_url)
+        transactions_after = transaction_count(args.database_url, args.sslmode)
+        with stats._lock:
+            latencies = {name: list(samples) for name, samples in stats.latencies.items()}
+            errors = dict(stats.errors)
+            fanout = list(stats.fanout)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    ingest = latencies.get("POST /api/mt4data", [])
+    accepted = len(ingest) - errors.get("POST /api/mt4data", 0)
+    queries = queries_after - queries_before if queries_before is not None and queries_after is not None else None
+    transactions = transactions_after - transactions_before if transactions_before is not None and transactions_after is not None else None
+    result = {
+        "revision": git_revision(),
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key != "database_url"},
+        "duration_s": round(elapsed, 3),
+        "ingest": {
+            "requests": len(ingest),
+            "accepted": accepted,
+            "throughput_rps": round(accepted / elapsed, 2),
+            "target_rps": args.terminals * args.rate
+        },
+        "latency": {name: percentiles(samples) for name, samples in sorted(latencies.items())},
+        "errors": errors,
+        "fanout": percentiles(fanout),
+        "socket_clients": len(clients),
+        "db": {
+            "transactions": transactions,
+            "transactions_per_ingest": round(transactions / accepted, 3) if transactions is not None and accepted else None,
+            # statement counts come from /metrics and so cover only the worker that answered the scrape
+            "sampled_worker_queries": queries
+        }
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import os
+import sys
+
+os.environ.setdefault("MT4_SERVER_ROLE", "cli")
+
+import mt4_online_server as server
+
+COMMANDS = {
+    "migrate": server.migrate,
+    "backfill-daily-rollups": server.backfill_history_daily,
+}
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in COMMANDS:
+        print(f"Usage: python manage.py <{'|'.join(COMMANDS)}>")
+        return 2
+    COMMANDS[argv[1]]()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
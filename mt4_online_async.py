@@ -0,0 +1,20 @@
+# Async entry point: every request, socket and DB call runs on an eventlet green thread.
+#   gunicorn --worker-class eventlet --worker-connections 2000 mt4_online_async:app
+# Patching has to happen before flask, psycopg2 or the server module are imported.
+import eventlet
+
+eventlet.monkey_patch()
+
+from psycogreen.eventlet import patch_psycopg
+
+# psycopg2 waits on its sockets through eventlet instead of blocking the whole worker
+patch_psycopg()
+
+import os
+
+os.environ.setdefault("SOCKETIO_ASYNC_MODE", "eventlet")
+
+from mt4_online_server import app, socketio  # noqa: E402
+
+if __name__ == "__main__":
+    socketio.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
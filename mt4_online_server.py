@@ -1,309 +1,1690 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import atexit
+import csv
+import gzip
+import io
 import logging
 import os
 import json
-import re
+import heapq
+import itertools
+import random
+import select
+import sys
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta
 import pytz
 from apscheduler.schedulers.background import BackgroundScheduler
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REDIS_URL = os.getenv("REDIS_URL")
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", REDIS_URL)
+SOCKETIO_CHANNEL = os.getenv("SOCKETIO_CHANNEL", "mt4-online-server")
+# Set to "websocket" when several workers/nodes sit behind a balancer without sticky sessions
+SOCKETIO_TRANSPORTS = [transport for transport in os.getenv("SOCKETIO_TRANSPORTS", "polling,websocket").split(",") if transport]
+# mt4_online_async sets this to "eventlet"; pinned otherwise so an installed eventlet is not picked up by sync workers
+SOCKETIO_ASYNC_MODE = os.getenv("SOCKETIO_ASYNC_MODE", "threading")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    def __init__(self, kind, name, help_text, labels=()):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _label_str(self, label_values, extra=()):
+        pairs = [f'{label}="{escape_label(value)}"' for label, value in (*zip(self.labels, label_values), *extra)]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter(Metric):
+    def __init__(self, name, help_text, labels=()):
+        super().__init__("counter", name, help_text, labels)
+
+    def inc(self, *label_values, value=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def render(self):
+        with self._lock:
+            return [f"{self.name}{self._label_str(key)} {value}" for key, value in self._values.items()]
+
+class Gauge(Counter):
+    def __init__(self, name, help_text, labels=()):
+        Metric.__init__(self, "gauge", name, help_text, labels)
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+class Histogram(Metric):
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__("histogram", name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                # per-bucket (non-cumulative) counts, then sum and count
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append(f"{self.name}_bucket{self._label_str(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{self._label_str(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{self._label_str(key)} {total}")
+                lines.append(f"{self.name}_count{self._label_str(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_LATENCY = metrics.register(Histogram("mt4_http_request_duration_seconds", "Flask request latency", ("route", "method", "status")))
+DB_CHECKOUT = metrics.register(Histogram("mt4_db_checkout_seconds", "Time to get a pooled connection", ("site",)))
+DB_QUERY = metrics.register(Histogram("mt4_db_query_seconds", "Statement execution time", ("site",)))
+INGEST_ACCOUNTS = metrics.register(Counter("mt4_ingest_accounts_total", "Account snapshots accepted", ("broker",)))
+INGEST_UNCHANGED = metrics.register(Counter("mt4_ingest_unchanged_total", "Snapshots identical to the live record; upsert and emit skipped", ("broker",)))
+JOB_DURATION = metrics.register(Histogram("mt4_job_duration_seconds", "Scheduler job run time", ("job",)))
+JOB_ERRORS = metrics.register(Counter("mt4_job_errors_total", "Scheduler jobs that raised", ("job",)))
+JOB_LAST_RUN = metrics.register(Gauge("mt4_job_last_run_timestamp_seconds", "Unix time the job last finished", ("job",)))
+SCHEDULER_LEADER = metrics.register(Gauge("mt4_scheduler_leader", "1 when this worker runs the cluster-wide jobs"))
+SOCKET_EMITS = metrics.register(Counter("mt4_socketio_emits_total", "Socket.IO emits", ("event",)))
+SOCKET_EMIT_BYTES = metrics.register(Counter("mt4_socketio_emit_bytes_total", "Bytes of encoded Socket.IO event packets", ("event",)))
+SOCKET_CLIENTS = metrics.register(Gauge("mt4_socketio_connected_clients", "Dashboards connected to this worker", ("format",)))
+POOL_CONNECTIONS = metrics.register(Gauge("mt4_db_pool_connections", "Connection pool state", ("state",)))
+FLEET_ACCOUNTS = metrics.register(Gauge("mt4_fleet_accounts", "Accounts held in the live fleet"))
+
+# Frames that are only plumbing (psycopg2, contextlib, the pool helpers) are skipped so the label names the caller
+CALL_SITE_SKIP = {"getconn", "db_connection", "execute", "executemany", "__enter__", "__exit__"}
+
+def call_site(depth=2):
+    frame = sys._getframe(depth)
+    while frame is not None and (frame.f_code.co_name in CALL_SITE_SKIP
+                                 or frame.f_globals.get("__name__", "").startswith(("psycopg2", "contextlib"))):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            DB_QUERY.observe(time.perf_counter() - started, call_site())
+
+class InstrumentedSocketIO(SocketIO):
+    def emit(self, event, *args, **kwargs):
+        SOCKET_EMITS.inc(event)
+        return super().emit(event, *args, **kwargs)
+
+class PacketJSON:
+    # Handed to python-socketio as its json module, so bytes are counted from the packet encoding it
+    # already does instead of serializing every payload a second time. Event packets encode [event, *args].
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        encoded = json.dumps(obj, *args, **kwargs)
+        if type(obj) is list and obj and type(obj[0]) is str:
+            SOCKET_EMIT_BYTES.inc(obj[0], value=len(encoded))
+        return encoded
+
+    @staticmethod
+    def loads(data, *args, **kwargs):
+        return json.loads(data, *args, **kwargs)
+
+job_runs = {}
+
+def timed_job(func):
+    name = func.__name__
+    stats = job_runs[name] = {"runs": 0, "errors": 0, "last_finished": None, "last_duration": None}
+
+    def run():
+        started = time.perf_counter()
+        try:
+            return func()
+        except Exception:
+            JOB_ERRORS.inc(name)
+            stats["errors"] += 1
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            finished = time.time()
+            JOB_DURATION.observe(duration, name)
+            JOB_LAST_RUN.set(finished, name)
+            stats["runs"] += 1
+            stats["last_finished"] = datetime.fromtimestamp(finished, pytz.UTC).isoformat()
+            stats["last_duration"] = round(duration, 6)
+    # APScheduler names jobs by qualname
+    run.__name__ = run.__qualname__ = name
+    return run
+
 app = Flask(__name__)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = InstrumentedSocketIO(
+    app,
+    cors_allowed_origins="*",
+    message_queue=SOCKETIO_MESSAGE_QUEUE,
+    channel=SOCKETIO_CHANNEL,
+    transports=SOCKETIO_TRANSPORTS,
+    async_mode=SOCKETIO_ASYNC_MODE,
+    json=PacketJSON
+)
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger("mt4_online_server")
 
 DB_URL = os.getenv("DATABASE_URL")
+# Heroku Postgres needs SSL; local databases (benchmarks, development) usually run with "disable"
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
+# Fraction of ingest requests whose raw body is logged at DEBUG; 0 disables it
+RAW_BODY_LOG_RATE = float(os.getenv("RAW_BODY_LOG_RATE", 0))
+WORKER_ID = uuid.uuid4().hex
+WORKER_ROOM = f"worker:{WORKER_ID}"
+# Dashboards pick an account_update encoding with ?format= on connect
+ACCOUNT_FORMATS = ("json", "columnar")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_MAX_AGE = float(os.getenv("DB_POOL_MAX_AGE", 1800))
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", 30))
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", 300))
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", 5))
+HISTORY_PARTITIONS_AHEAD = int(os.getenv("HISTORY_PARTITIONS_AHEAD", 7))
+HISTORY_RAW_RETENTION_DAYS = int(os.getenv("HISTORY_RAW_RETENTION_DAYS", 30))
+HISTORY_1M_RETENTION_DAYS = int(os.getenv("HISTORY_1M_RETENTION_DAYS", 90))
+HISTORY_1H_RETENTION_DAYS = int(os.getenv("HISTORY_1H_RETENTION_DAYS", 730))
+HISTORY_1D_RETENTION_DAYS = int(os.getenv("HISTORY_1D_RETENTION_DAYS", 0))
+HISTORY_MAINTENANCE_MINUTES = int(os.getenv("HISTORY_MAINTENANCE_MINUTES", 5))
+HISTORY_STREAM_CHUNK = int(os.getenv("HISTORY_STREAM_CHUNK", 1000))
+SERIES_MAX_POINTS = int(os.getenv("SERIES_MAX_POINTS", 5000))
+ALERT_TICK_SECONDS = float(os.getenv("ALERT_TICK_SECONDS", 2))
+ALERT_COOLDOWN_SECONDS = float(os.getenv("ALERT_COOLDOWN_SECONDS", 300))
+ALERT_HYSTERESIS = float(os.getenv("ALERT_HYSTERESIS", 0.05))
+EVICTION_ARCHIVE = os.getenv("EVICTION_ARCHIVE", "false").lower() == "true"
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+SKIP_UNCHANGED = os.getenv("SKIP_UNCHANGED", "true").lower() == "true"
+LEADER_CHECK_SECONDS = float(os.getenv("LEADER_CHECK_SECONDS", 10))
+LIVENESS_FLUSH_SECONDS = float(os.getenv("LIVENESS_FLUSH_SECONDS", 15))
+INGEST_BUFFER_ENABLED = os.getenv("INGEST_BUFFER_ENABLED", "false").lower() == "true"
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", 2))
+INGEST_FLUSH_SIZE = int(os.getenv("INGEST_FLUSH_SIZE", 500))
 
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(DB_URL, sslmode="require")
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10, max_age=1800, check_idle=30):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, last_used), most recently used last
+        self._created_at = {}
+        self._size = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.created = 0
+        self.recycled = 0
+        self.timeouts = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, sslmode=DB_SSLMODE, cursor_factory=TimedCursor)
+        with self._cond:
+            self._created_at[conn] = time.monotonic()
+            self.created += 1
         return conn
-    except Exception as e:
-        logger.error(f"Database connection failed: {e}")
-        return None
 
-def create_tables():
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Cannot create tables: No database connection")
-        return
-    cur = conn.cursor()
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(conn, None)
+            self._size -= 1
+            self.recycled += 1
+            self._cond.notify()
+
+    def _is_alive(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._created_at.get(conn, 0) > self.max_age:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        started = time.perf_counter()
+        try:
+            return self._getconn()
+        finally:
+            DB_CHECKOUT.observe(time.perf_counter() - started, call_site())
+
+    def _getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            entry = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                    self.waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    self._size += 1
+                self.in_use += 1
+            if entry is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self.in_use -= 1
+                        self._cond.notify()
+                    raise
+            conn, last_used = entry
+            if self._is_alive(conn, last_used):
+                return conn
+            with self._cond:
+                self.in_use -= 1
+            self._discard(conn)
+
+    def putconn(self, conn, discard=False):
+        with self._cond:
+            self.in_use -= 1
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed or time.monotonic() - self._created_at.get(conn, 0) > self.max_age:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def maintain(self):
+        now = time.monotonic()
+        with self._cond:
+            expired = [entry for entry in self._idle if now - self._created_at.get(entry[0], 0) > self.max_age]
+            self._idle = [entry for entry in self._idle if entry not in expired]
+        for conn, _ in expired:
+            self._discard(conn)
+        while True:
+            with self._cond:
+                if self._size >= self.min_size or self._size >= self.max_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception as e:
+                with self._cond:
+                    self._size -= 1
+                logger.error(f"Database connection failed: {e}")
+                return
+            with self._cond:
+                self._idle.insert(0, (conn, time.monotonic()))
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "created": self.created,
+                "recycled": self.recycled,
+                "timeouts": self.timeouts,
+                "min_size": self.min_size,
+                "max_size": self.max_size
+            }
+
+db_pool = ConnectionPool(
+    DB_URL,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    max_age=DB_POOL_MAX_AGE,
+    check_idle=DB_POOL_CHECK_IDLE
+)
+
+@contextmanager
+def db_connection():
+    conn = db_pool.getconn()
+    broken = False
     try:
-        cur.execute("DROP TABLE IF EXISTS settings;")
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS accounts (
-                broker TEXT NOT NULL,
-                account_number BIGINT PRIMARY KEY,
-                balance DOUBLE PRECISION DEFAULT 0,
-                equity DOUBLE PRECISION DEFAULT 0,
-                margin_used DOUBLE PRECISION DEFAULT 0,
-                free_margin DOUBLE PRECISION DEFAULT 0,
-                margin_percent DOUBLE PRECISION DEFAULT 0,
-                profit_loss DOUBLE PRECISION DEFAULT 0,
-                realized_pl_daily DOUBLE PRECISION DEFAULT 0,
-                realized_pl_weekly DOUBLE PRECISION DEFAULT 0,
-                realized_pl_monthly DOUBLE PRECISION DEFAULT 0,
-                realized_pl_yearly DOUBLE PRECISION DEFAULT 0,
-                realized_pl_alltime DOUBLE PRECISION DEFAULT 0,
-                deposits_alltime DOUBLE PRECISION DEFAULT 0,
-                withdrawals_alltime DOUBLE PRECISION DEFAULT 0,
-                holding_fee_daily DOUBLE PRECISION DEFAULT 0,
-                holding_fee_weekly DOUBLE PRECISION DEFAULT 0,
-                holding_fee_monthly DOUBLE PRECISION DEFAULT 0,
-                holding_fee_yearly DOUBLE PRECISION DEFAULT 0,
-                holding_fee_alltime DOUBLE PRECISION DEFAULT 0,
-                open_charts INTEGER DEFAULT 0,
-                empty_charts INTEGER DEFAULT 0,
-                open_trades INTEGER DEFAULT 0,
-                autotrading BOOLEAN DEFAULT FALSE,
-                swap_daily DOUBLE PRECISION DEFAULT 0,
-                swap_weekly DOUBLE PRECISION DEFAULT 0,
-                swap_monthly DOUBLE PRECISION DEFAULT 0,
-                swap_yearly DOUBLE PRECISION DEFAULT 0,
-                swap_alltime DOUBLE PRECISION DEFAULT 0,
-                deposits_daily DOUBLE PRECISION DEFAULT 0,
-                deposits_weekly DOUBLE PRECISION DEFAULT 0,
-                deposits_monthly DOUBLE PRECISION DEFAULT 0,
-                deposits_yearly DOUBLE PRECISION DEFAULT 0,
-                withdrawals_daily DOUBLE PRECISION DEFAULT 0,
-                withdrawals_weekly DOUBLE PRECISION DEFAULT 0,
-                withdrawals_monthly DOUBLE PRECISION DEFAULT 0,
-                withdrawals_yearly DOUBLE PRECISION DEFAULT 0,
-                prev_day_pl DOUBLE PRECISION DEFAULT 0,
-                prev_day_holding_fee DOUBLE PRECISION DEFAULT 0,
-                last_update TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            );
-            CREATE INDEX IF NOT EXISTS idx_accounts_account_number ON accounts (account_number);
-            CREATE INDEX IF NOT EXISTS idx_accounts_broker ON accounts (broker);
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        db_pool.putconn(conn, discard=broken)
+
+class NotificationListener:
+    # Handlers get the NOTIFY payload, or None after a (re)connect when notifications may have been missed
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self._handlers = {}
+        self._thread = None
+        self.received = 0
+        self.reconnects = 0
+
+    def subscribe(self, channel, handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+        self._thread.start()
+
+    def _dispatch(self, channel, payload):
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error(f"Notification Handler Error ({channel}): {e}")
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn, sslmode=DB_SSLMODE)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    for channel in self._handlers:
+                        cur.execute(f"LISTEN {channel};")
+                self.reconnects += 1
+                for channel in self._handlers:
+                    self._dispatch(channel, None)
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1;")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.received += 1
+                        self._dispatch(notify.channel, notify.payload)
+            except Exception as e:
+                logger.error(f"Notification Listener Error: {e}")
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+notification_listener = NotificationListener(DB_URL)
+
+SETTINGS_COLUMNS = [
+    "sort_state", "is_numbers_masked", "gmt_offset", "period_resets",
+    "main_refresh_rate", "critical_margin", "warning_margin", "is_dark_mode",
+    "mask_timer", "font_size", "notes", "broker_offsets", "alert_thresholds",
+    "alerts_enabled", "sound_enabled", "default_settings_timestamp", "account_timeout", "focus_group"
+]
+
+class SettingsCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._settings = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.loads = 0
+
+    def get(self):
+        settings = self._settings
+        if settings is not None and time.monotonic() - self._loaded_at < self.ttl:
+            self.hits += 1
+            return settings
+        with self._lock:
+            if self._settings is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._settings
+            generation = self.generation
+            previous = self._settings
+            with db_connection() as conn, conn.cursor() as cur:
+                cur.execute(f"SELECT {', '.join(SETTINGS_COLUMNS)} FROM settings WHERE user_id = 'default';")
+                row = cur.fetchone()
+            settings = dict(zip(SETTINGS_COLUMNS, row)) if row else {}
+            if settings.get('default_settings_timestamp'):
+                settings['default_settings_timestamp'] = settings['default_settings_timestamp'].isoformat()
+            self.loads += 1
+            if generation == self.generation:
+                if previous is not None and settings != previous:
+                    # The TTL reload caught a change whose NOTIFY never arrived; tags built on the generation move too
+                    self.generation += 1
+                self._settings = settings
+                self._loaded_at = time.monotonic()
+            return settings
+
+    def invalidate(self, payload=None):
+        self.generation += 1
+        self._settings = None
+
+    def stats(self):
+        return {"generation": self.generation, "hits": self.hits, "loads": self.loads}
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL)
+notification_listener.subscribe("settings_changed", settings_cache.invalidate)
+
+class Generation:
+    def __init__(self):
+        self.value = 0
+
+    def bump(self, payload=None):
+        self.value += 1
+
+# Bumped (via NOTIFY, on every worker) whenever history_daily changes
+history_generation = Generation()
+notification_listener.subscribe("history_changed", history_generation.bump)
+
+def get_account_timeout():
+    return settings_cache.get().get('account_timeout', 2)
+
+SCHEMA_LOCK_ID = 4_741_001
+HISTORY_MAINTENANCE_LOCK_ID = 4_741_002
+SCHEDULER_LEADER_LOCK_ID = 4_741_003
+
+# id is BIGINT for new databases; a converted table keeps its serial INTEGER so attaching it rewrites nothing
+HISTORY_COLUMNS_DDL = """
+    id {id_type} NOT NULL DEFAULT nextval('history_id_seq'),
+    account_number BIGINT,
+    balance DOUBLE PRECISION,
+    equity DOUBLE PRECISION,
+    margin_used DOUBLE PRECISION,
+    free_margin DOUBLE PRECISION,
+    margin_level DOUBLE PRECISION,
+    open_trade INTEGER DEFAULT 0,
+    profit_loss DOUBLE PRECISION,
+    open_charts INTEGER,
+    deposit_withdrawal DOUBLE PRECISION,
+    margin_percent DOUBLE PRECISION,
+    realized_pl_daily DOUBLE PRECISION,
+    realized_pl_weekly DOUBLE PRECISION,
+    realized_pl_monthly DOUBLE PRECISION,
+    realized_pl_yearly DOUBLE PRECISION,
+    autotrading BOOLEAN,
+    empty_charts INTEGER,
+    deposits_alltime DOUBLE PRECISION,
+    withdrawals_alltime DOUBLE PRECISION,
+    realized_pl_alltime DOUBLE PRECISION,
+    holding_fee_daily DOUBLE PRECISION,
+    broker TEXT,
+    traded_pairs TEXT,
+    open_pairs_charts TEXT,
+    ea_names TEXT,
+    snapshot_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_update TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id, snapshot_time)
+"""
+
+ROLLUP_METRICS = ["balance", "equity", "profit_loss", "margin_percent", "free_margin", "open_trade"]
+# (resolution, source table, date_trunc unit, source retention days, max window per run)
+ROLLUP_LEVELS = [
+    ("1m", "history", "minute", HISTORY_RAW_RETENTION_DAYS, timedelta(days=1)),
+    ("1h", "history_1m", "hour", HISTORY_1M_RETENTION_DAYS, timedelta(days=7)),
+    ("1d", "history_1h", "day", HISTORY_1H_RETENTION_DAYS, timedelta(days=90))
+]
+
+def create_history_storage(cur):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('history');")
+    row = cur.fetchone()
+    if row and row[0] == 'r':
+        convert_history_to_partitioned(cur)
+    else:
+        cur.execute(f"""
+            CREATE SEQUENCE IF NOT EXISTS history_id_seq;
+            CREATE TABLE IF NOT EXISTS history ({HISTORY_COLUMNS_DDL.format(id_type="BIGINT")}) PARTITION BY RANGE (snapshot_time);
+            CREATE TABLE IF NOT EXISTS history_default PARTITION OF history DEFAULT;
         """)
-        cur.execute("""
-            CREATE TABLE settings (
-                user_id TEXT PRIMARY KEY,
-                sort_state JSON,
-                is_numbers_masked BOOLEAN DEFAULT FALSE,
-                gmt_offset INTEGER DEFAULT 3,
-                period_resets JSON,
-                main_refresh_rate INTEGER DEFAULT 5,
-                critical_margin INTEGER DEFAULT 0,
-                warning_margin INTEGER DEFAULT 500,
-                is_dark_mode BOOLEAN DEFAULT TRUE,
-                mask_timer TEXT DEFAULT 'never',
-                font_size TEXT DEFAULT '14',
-                notes JSON,
-                broker_offsets JSON DEFAULT '{"Raw Trading Ltd": 3, "Swissquote": 5, "XTB International": -6}',
-                alert_thresholds JSON DEFAULT '{"equity": 500, "profit_loss": -1000, "margin_percent": 20, "open_trades": 50}',
-                alerts_enabled BOOLEAN DEFAULT TRUE,
-                sound_enabled BOOLEAN DEFAULT FALSE,
-                account_timeout INTEGER DEFAULT 2,
-                focus_group JSON DEFAULT '[]',
-                default_settings_timestamp TIMESTAMP WITH TIME ZONE
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_history_snapshot_time ON history (snapshot_time);
+        CREATE INDEX IF NOT EXISTS idx_history_account_number ON history (account_number);
+        CREATE INDEX IF NOT EXISTS idx_history_broker ON history (broker);
+        CREATE TABLE IF NOT EXISTS history_rollup_state (
+            resolution TEXT PRIMARY KEY,
+            rolled_until TIMESTAMP WITH TIME ZONE
+        );
+        CREATE TABLE IF NOT EXISTS history_daily (
+            day DATE NOT NULL,
+            broker TEXT NOT NULL DEFAULT '',
+            account_number BIGINT NOT NULL,
+            profit_loss_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            open_trade_sum BIGINT NOT NULL DEFAULT 0,
+            samples INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, broker, account_number)
+        );
+    """)
+    metric_columns = ",\n".join(
+        f"{metric}_{agg} DOUBLE PRECISION" for metric in ROLLUP_METRICS for agg in ("min", "max", "sum", "last")
+    )
+    for resolution, _, _, _, _ in ROLLUP_LEVELS:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS history_{resolution} (
+                account_number BIGINT NOT NULL,
+                bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+                broker TEXT,
+                samples INTEGER NOT NULL,
+                last_time TIMESTAMP WITH TIME ZONE,
+                {metric_columns},
+                PRIMARY KEY (account_number, bucket)
             );
-            INSERT INTO settings (user_id, account_timeout) 
-            VALUES ('default', 2) 
-            ON CONFLICT (user_id) DO NOTHING;
+            CREATE INDEX IF NOT EXISTS idx_history_{resolution}_bucket ON history_{resolution} (bucket);
+            CREATE INDEX IF NOT EXISTS idx_history_{resolution}_broker ON history_{resolution} (broker, bucket);
         """)
+    ensure_history_partitions(cur)
+
+def convert_history_to_partitioned(cur):
+    # The old heap becomes the partition holding everything before tomorrow, so no rows are copied or rewritten.
+    # The scans (null cleanup, bound validation, the unique index the parent key needs) run before the
+    # ACCESS EXCLUSIVE lock, under locks that let /api/history keep reading; with the bound proven by a
+    # validated CHECK, SET NOT NULL and ATTACH PARTITION skip their own scans.
+    boundary = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    logger.info("Converting history to a time-partitioned table")
+    cur.execute("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = 'history'::regclass AND attname = 'id';
+    """)
+    id_type = cur.fetchone()[0]
+    cur.execute("""
+        DELETE FROM history WHERE snapshot_time IS NULL;
+        ALTER TABLE history ADD CONSTRAINT history_legacy_bound
+            CHECK (snapshot_time IS NOT NULL AND snapshot_time < %s) NOT VALID;
+        ALTER TABLE history VALIDATE CONSTRAINT history_legacy_bound;
+        CREATE UNIQUE INDEX IF NOT EXISTS history_legacy_id_snapshot_time_idx ON history (id, snapshot_time);
+    """, (boundary.isoformat(),))
+    cur.execute(f"""
+        LOCK TABLE history IN ACCESS EXCLUSIVE MODE;
+        ALTER TABLE history RENAME TO history_legacy;
+        ALTER INDEX IF EXISTS idx_history_snapshot_time RENAME TO history_legacy_snapshot_time_idx;
+        ALTER INDEX IF EXISTS idx_history_account_number RENAME TO history_legacy_account_number_idx;
+        ALTER INDEX IF EXISTS idx_history_broker RENAME TO history_legacy_broker_idx;
+        ALTER TABLE history_legacy DROP CONSTRAINT IF EXISTS history_pkey;
+        ALTER SEQUENCE IF EXISTS history_id_seq OWNED BY NONE;
+        ALTER TABLE history_legacy ALTER COLUMN snapshot_time SET NOT NULL;
+        CREATE SEQUENCE IF NOT EXISTS history_id_seq;
+        ALTER TABLE history_legacy ALTER COLUMN id SET DEFAULT nextval('history_id_seq');
+        CREATE TABLE history ({HISTORY_COLUMNS_DDL.format(id_type=id_type)}) PARTITION BY RANGE (snapshot_time);
+        ALTER TABLE history ATTACH PARTITION history_legacy FOR VALUES FROM (MINVALUE) TO (%s);
+        ALTER TABLE history_legacy DROP CONSTRAINT history_legacy_bound;
+        CREATE TABLE history_default PARTITION OF history DEFAULT;
+    """, (boundary.isoformat(),))
+
+def history_partitions(cur):
+    cur.execute("""
+        SELECT c.relname,
+               (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'FROM \\(''([^'']+)''\\)'))[1]::timestamptz,
+               (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \\(''([^'']+)''\\)'))[1]::timestamptz,
+               pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT'
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'history'::regclass;
+    """)
+    return cur.fetchall()
+
+def ensure_history_partitions(cur):
+    ranges = [(lower, upper) for _, lower, upper, is_default in history_partitions(cur) if not is_default]
+    today = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+    created = 0
+    for offset in range(HISTORY_PARTITIONS_AHEAD + 1):
+        start = today + timedelta(days=offset)
+        end = start + timedelta(days=1)
+        if any((lower is None or lower < end) and (upper is None or upper > start) for lower, upper in ranges):
+            continue
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS history_p{start:%Y%m%d} PARTITION OF history
+            FOR VALUES FROM (%s) TO (%s);
+        """, (start.isoformat(), end.isoformat()))
+        ranges.append((start, end))
+        created += 1
+    return created
+
+def rollup_sql(resolution, source, unit):
+    if source == "history":
+        time_column, samples, last_time = "snapshot_time", "COUNT(*)", "MAX(snapshot_time)"
+        aggregates = [
+            f"MIN({metric}), MAX({metric}), SUM({metric}), (array_agg({metric} ORDER BY snapshot_time DESC))[1]"
+            for metric in ROLLUP_METRICS
+        ]
+        where = "account_number IS NOT NULL AND "
+    else:
+        time_column, samples, last_time = "bucket", "SUM(samples)", "MAX(last_time)"
+        aggregates = [
+            f"MIN({metric}_min), MAX({metric}_max), SUM({metric}_sum), (array_agg({metric}_last ORDER BY last_time DESC))[1]"
+            for metric in ROLLUP_METRICS
+        ]
+        where = ""
+    target = f"history_{resolution}"
+    metric_columns = [f"{metric}_{agg}" for metric in ROLLUP_METRICS for agg in ("min", "max", "sum", "last")]
+    updates = []
+    for metric in ROLLUP_METRICS:
+        updates += [
+            f"{metric}_min = LEAST({target}.{metric}_min, EXCLUDED.{metric}_min)",
+            f"{metric}_max = GREATEST({target}.{metric}_max, EXCLUDED.{metric}_max)",
+            f"{metric}_sum = COALESCE({target}.{metric}_sum, 0) + COALESCE(EXCLUDED.{metric}_sum, 0)",
+            f"{metric}_last = CASE WHEN EXCLUDED.last_time >= {target}.last_time THEN EXCLUDED.{metric}_last ELSE {target}.{metric}_last END"
+        ]
+    return f"""
+        INSERT INTO {target} (account_number, bucket, broker, samples, last_time, {', '.join(metric_columns)})
+        SELECT account_number, date_trunc('{unit}', {time_column}, 'UTC') AS rollup_bucket,
+               (array_agg(broker ORDER BY {time_column} DESC))[1], {samples}, {last_time},
+               {', '.join(aggregates)}
+        FROM {source}
+        WHERE {where}{time_column} >= %(start)s AND {time_column} < %(end)s
+        GROUP BY account_number, rollup_bucket
+        ON CONFLICT (account_number, bucket) DO UPDATE SET
+            broker = EXCLUDED.broker,
+            samples = {target}.samples + EXCLUDED.samples,
+            {', '.join(updates)},
+            last_time = GREATEST({target}.last_time, EXCLUDED.last_time);
+    """
+
+UNIT_STEPS = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+def truncate_to(moment, unit):
+    if unit == "minute":
+        return moment.replace(second=0, microsecond=0)
+    if unit == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def ceil_to(moment, unit):
+    floor = truncate_to(moment, unit)
+    return floor if floor == moment else floor + UNIT_STEPS[unit]
+
+def save_rollup_state(cur, resolution, rolled_until, late_since):
+    cur.execute("""
+        INSERT INTO history_rollup_state (resolution, rolled_until, late_since) VALUES (%s, %s, %s)
+        ON CONFLICT (resolution) DO UPDATE SET rolled_until = EXCLUDED.rolled_until, late_since = EXCLUDED.late_since;
+    """, (resolution, rolled_until, late_since))
+
+def rollup_history(cur):
+    # Returns how far each resolution's buckets are complete. Rows inserted behind the 1m watermark set
+    # late_since (mark_history_late); from there the buckets are deleted and rolled up again, window by
+    # window, and each rebuilt range marks the next level late in turn. FOR UPDATE makes a late insert that
+    # races a run wait for it and mark against the state it leaves behind.
+    cur.execute("SELECT resolution, rolled_until, late_since FROM history_rollup_state FOR UPDATE;")
+    state = {resolution: [rolled_until, late_since] for resolution, rolled_until, late_since in cur.fetchall()}
+    now = datetime.now(pytz.UTC)
+    # Raw rows are rolled up two minutes behind real time to let the current minute settle
+    ready_until = now - timedelta(minutes=2)
+    complete = {}
+    for index, (resolution, source, unit, source_retention, max_window) in enumerate(ROLLUP_LEVELS):
+        rolled_until, late_since = state.get(resolution, [None, None])
+        sql = rollup_sql(resolution, source, unit)
+        changed = False
+        if late_since is not None:
+            start = truncate_to(late_since.astimezone(pytz.UTC), unit)
+            if source_retention > 0:
+                # Source rows past retention are gone; rebuilding their buckets would empty them
+                start = max(start, ceil_to(now - timedelta(days=source_retention), unit))
+            end = min(rolled_until, start + max_window, truncate_to(ready_until, unit))
+            if start >= rolled_until:
+                late_since = None
+            elif end > start:
+                cur.execute(f"DELETE FROM history_{resolution} WHERE bucket >= %s AND bucket < %s;", (start, end))
+                cur.execute(sql, {"start": start, "end": end})
+                if index + 1 < len(ROLLUP_LEVELS):
+                    following = state.get(ROLLUP_LEVELS[index + 1][0])
+                    if following and following[0] is not None and following[0] > start:
+                        following[1] = min(following[1] or start, start)
+                late_since = end if end < rolled_until else None
+            else:
+                # Waits for the source level to finish rebuilding this range first
+                late_since = start
+            changed = True
+        end = truncate_to(ready_until, unit)
+        start = rolled_until
+        if start is None:
+            time_column = "snapshot_time" if source == "history" else "bucket"
+            cur.execute(f"SELECT MIN({time_column}) FROM {source};")
+            first = cur.fetchone()[0]
+            start = truncate_to(first.astimezone(pytz.UTC), unit) if first else end
+        end = min(end, start + max_window)
+        if end > start:
+            cur.execute(sql, {"start": start, "end": end})
+            rolled_until, changed = end, True
+        if changed:
+            save_rollup_state(cur, resolution, rolled_until, late_since)
+        complete[resolution] = late_since or rolled_until
+        # The next level only consumes buckets this level has completely rolled up
+        ready_until = complete[resolution] or start
+    return complete
+
+def mark_history_late(cur, rows):
+    # Rows behind the 1m watermark would never be rolled up; point the next run back at their minute
+    earliest = min(row[HISTORY_SNAPSHOT_INDEX] for row in rows)
+    cur.execute("""
+        UPDATE history_rollup_state
+        SET late_since = LEAST(late_since, date_trunc('minute', %(earliest)s::timestamptz, 'UTC'))
+        WHERE resolution = '1m' AND rolled_until > %(earliest)s;
+    """, {"earliest": earliest})
+
+def apply_history_retention(cur, watermarks):
+    now = datetime.now(pytz.UTC)
+    dropped = 0
+    raw_cutoff = min(now - timedelta(days=HISTORY_RAW_RETENTION_DAYS), watermarks.get("1m") or now - timedelta(days=36500))
+    if HISTORY_RAW_RETENTION_DAYS > 0:
+        for name, _, upper, is_default in history_partitions(cur):
+            if is_default:
+                cur.execute("DELETE FROM history_default WHERE snapshot_time < %s;", (raw_cutoff,))
+            elif upper is not None and upper <= raw_cutoff:
+                cur.execute(f'DROP TABLE IF EXISTS "{name}";')
+                dropped += 1
+    for index, (resolution, _, _, _, _) in enumerate(ROLLUP_LEVELS):
+        retention_days = ROLLUP_LEVELS[index + 1][3] if index + 1 < len(ROLLUP_LEVELS) else HISTORY_1D_RETENTION_DAYS
+        if retention_days <= 0:
+            continue
+        cutoff = now - timedelta(days=retention_days)
+        if index + 1 < len(ROLLUP_LEVELS):
+            cutoff = min(cutoff, watermarks.get(ROLLUP_LEVELS[index + 1][0]) or cutoff - timedelta(days=36500))
+        cur.execute(f"DELETE FROM history_{resolution} WHERE bucket < %s;", (cutoff,))
+    return dropped
+
+def maintain_history():
+    try:
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (HISTORY_MAINTENANCE_LOCK_ID,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return
+            try:
+                created = ensure_history_partitions(cur)
+                conn.commit()
+                watermarks = rollup_history(cur)
+                conn.commit()
+                dropped = apply_history_retention(cur, watermarks)
+                conn.commit()
+            finally:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(%s);", (HISTORY_MAINTENANCE_LOCK_ID,))
+                conn.commit()
+        if created or dropped:
+            logger.info(f"History maintenance created {created} and dropped {dropped} partitions")
+    except Exception as e:
+        logger.error(f"History Maintenance Error: {e}", exc_info=True)
+
+def migrate_accounts_and_settings(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            broker TEXT NOT NULL,
+            account_number BIGINT PRIMARY KEY,
+            balance DOUBLE PRECISION DEFAULT 0,
+            equity DOUBLE PRECISION DEFAULT 0,
+            margin_used DOUBLE PRECISION DEFAULT 0,
+            free_margin DOUBLE PRECISION DEFAULT 0,
+            margin_percent DOUBLE PRECISION DEFAULT 0,
+            profit_loss DOUBLE PRECISION DEFAULT 0,
+            realized_pl_daily DOUBLE PRECISION DEFAULT 0,
+            realized_pl_weekly DOUBLE PRECISION DEFAULT 0,
+            realized_pl_monthly DOUBLE PRECISION DEFAULT 0,
+            realized_pl_yearly DOUBLE PRECISION DEFAULT 0,
+            realized_pl_alltime DOUBLE PRECISION DEFAULT 0,
+            deposits_alltime DOUBLE PRECISION DEFAULT 0,
+            withdrawals_alltime DOUBLE PRECISION DEFAULT 0,
+            holding_fee_daily DOUBLE PRECISION DEFAULT 0,
+            holding_fee_weekly DOUBLE PRECISION DEFAULT 0,
+            holding_fee_monthly DOUBLE PRECISION DEFAULT 0,
+            holding_fee_yearly DOUBLE PRECISION DEFAULT 0,
+            holding_fee_alltime DOUBLE PRECISION DEFAULT 0,
+            open_charts INTEGER DEFAULT 0,
+            empty_charts INTEGER DEFAULT 0,
+            open_trades INTEGER DEFAULT 0,
+            autotrading BOOLEAN DEFAULT FALSE,
+            swap_daily DOUBLE PRECISION DEFAULT 0,
+            swap_weekly DOUBLE PRECISION DEFAULT 0,
+            swap_monthly DOUBLE PRECISION DEFAULT 0,
+            swap_yearly DOUBLE PRECISION DEFAULT 0,
+            swap_alltime DOUBLE PRECISION DEFAULT 0,
+            deposits_daily DOUBLE PRECISION DEFAULT 0,
+            deposits_weekly DOUBLE PRECISION DEFAULT 0,
+            deposits_monthly DOUBLE PRECISION DEFAULT 0,
+            deposits_yearly DOUBLE PRECISION DEFAULT 0,
+            withdrawals_daily DOUBLE PRECISION DEFAULT 0,
+            withdrawals_weekly DOUBLE PRECISION DEFAULT 0,
+            withdrawals_monthly DOUBLE PRECISION DEFAULT 0,
+            withdrawals_yearly DOUBLE PRECISION DEFAULT 0,
+            prev_day_pl DOUBLE PRECISION DEFAULT 0,
+            prev_day_holding_fee DOUBLE PRECISION DEFAULT 0,
+            last_update TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_accounts_account_number ON accounts (account_number);
+        CREATE INDEX IF NOT EXISTS idx_accounts_broker ON accounts (broker);
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            user_id TEXT PRIMARY KEY,
+            sort_state JSON,
+            is_numbers_masked BOOLEAN DEFAULT FALSE,
+            gmt_offset INTEGER DEFAULT 3,
+            period_resets JSON,
+            main_refresh_rate INTEGER DEFAULT 5,
+            critical_margin INTEGER DEFAULT 0,
+            warning_margin INTEGER DEFAULT 500,
+            is_dark_mode BOOLEAN DEFAULT TRUE,
+            mask_timer TEXT DEFAULT 'never',
+            font_size TEXT DEFAULT '14',
+            notes JSON,
+            broker_offsets JSON DEFAULT '{"Raw Trading Ltd": 3, "Swissquote": 5, "XTB International": -6}',
+            alert_thresholds JSON DEFAULT '{"equity": 500, "profit_loss": -1000, "margin_percent": 20, "open_trades": 50}',
+            alerts_enabled BOOLEAN DEFAULT TRUE,
+            sound_enabled BOOLEAN DEFAULT FALSE,
+            account_timeout INTEGER DEFAULT 2,
+            focus_group JSON DEFAULT '[]',
+            default_settings_timestamp TIMESTAMP WITH TIME ZONE
+        );
+        INSERT INTO settings (user_id, account_timeout) 
+        VALUES ('default', 2) 
+        ON CONFLICT (user_id) DO NOTHING;
+    """)
+
+def add_rollup_late_since(cur):
+    cur.execute("ALTER TABLE history_rollup_state ADD COLUMN IF NOT EXISTS late_since TIMESTAMP WITH TIME ZONE;")
+
+# Append-only: each migration runs once, in order, in its own transaction, and must be safe to re-run
+# against a database that predates the schema_migrations table
+MIGRATIONS = [
+    (1, "accounts and settings", migrate_accounts_and_settings),
+    (2, "partitioned history and rollups", create_history_storage),
+    (3, "re-roll history behind the rollup watermark", add_rollup_late_since),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def current_schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;")
+    return cur.fetchone()[0]
+
+def migrate():
+    with db_connection() as conn, conn.cursor() as cur:
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS history (
-                id SERIAL PRIMARY KEY,
-                account_number BIGINT,
-                balance DOUBLE PRECISION,
-                equity DOUBLE PRECISION,
-                margin_used DOUBLE PRECISION,
-                free_margin DOUBLE PRECISION,
-                margin_level DOUBLE PRECISION,
-                open_trade INTEGER DEFAULT 0,
-                profit_loss DOUBLE PRECISION,
-                open_charts INTEGER,
-                deposit_withdrawal DOUBLE PRECISION,
-                margin_percent DOUBLE PRECISION,
-                realized_pl_daily DOUBLE PRECISION,
-                realized_pl_weekly DOUBLE PRECISION,
-                realized_pl_monthly DOUBLE PRECISION,
-                realized_pl_yearly DOUBLE PRECISION,
-                autotrading BOOLEAN,
-                empty_charts INTEGER,
-                deposits_alltime DOUBLE PRECISION,
-                withdrawals_alltime DOUBLE PRECISION,
-                realized_pl_alltime DOUBLE PRECISION,
-                holding_fee_daily DOUBLE PRECISION,
-                broker TEXT,
-                traded_pairs TEXT,
-                open_pairs_charts TEXT,
-                ea_names TEXT,
-                snapshot_time TIMESTAMP WITH TIME ZONE,
-                last_update TIMESTAMP WITH TIME ZONE
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
             );
-            CREATE INDEX IF NOT EXISTS idx_history_snapshot_time ON history (snapshot_time);
-            CREATE INDEX IF NOT EXISTS idx_history_account_number ON history (account_number);
-            CREATE INDEX IF NOT EXISTS idx_history_broker ON history (broker);
         """)
         conn.commit()
-        logger.info("Tables created with indexes and default settings initialized")
+        for version, name, apply in MIGRATIONS:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (SCHEMA_LOCK_ID,))
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", (version,))
+            if cur.fetchone():
+                conn.rollback()
+                continue
+            logger.info(f"Applying migration {version}: {name}")
+            apply(cur)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+            conn.commit()
+        version = current_schema_version(cur)
+        conn.commit()
+    logger.info(f"Database schema at version {version}")
+    return version
+
+schema_status = {"version": None, "expected": SCHEMA_VERSION}
+
+def check_schema():
+    # Workers never run DDL; the release phase (python manage.py migrate) does
+    try:
+        with db_connection() as conn, conn.cursor() as cur:
+            schema_status["version"] = current_schema_version(cur)
+            conn.rollback()
     except Exception as e:
-        logger.error(f"Table creation failed: {e}")
-    finally:
-        cur.close()
-        conn.close()
+        logger.error(f"Schema version check failed: {e}")
+        return
+    if schema_status["version"] < SCHEMA_VERSION:
+        logger.error(f"Database schema is at version {schema_status['version']}, expected {SCHEMA_VERSION}; run `python manage.py migrate`")
+
+# Everything outside printable ASCII; multi-byte UTF-8 sequences are dropped whole, as the old decode+regex did
+NON_PRINTABLE_BYTES = bytes(b for b in range(256) if not 0x20 <= b <= 0x7E)
+
+def clean_payload(raw_data):
+    return raw_data.translate(None, NON_PRINTABLE_BYTES).strip()
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+ACCOUNT_FIELDS = [
+    "broker", "account_number", "balance", "equity", "margin_used",
+    "free_margin", "margin_percent", "profit_loss", "realized_pl_daily",
+    "realized_pl_weekly", "realized_pl_monthly", "realized_pl_yearly",
+    "realized_pl_alltime", "deposits_alltime", "withdrawals_alltime",
+    "holding_fee_daily", "holding_fee_weekly", "holding_fee_monthly",
+    "holding_fee_yearly", "holding_fee_alltime", "open_charts",
+    "empty_charts", "open_trades", "autotrading", "swap_daily",
+    "swap_weekly", "swap_monthly", "swap_yearly", "swap_alltime",
+    "deposits_daily", "deposits_weekly", "deposits_monthly",
+    "deposits_yearly", "withdrawals_daily", "withdrawals_weekly",
+    "withdrawals_monthly", "withdrawals_yearly", "prev_day_pl",
+    "prev_day_holding_fee"
+]
+
+ACCOUNT_UPSERT_SQL = """
+    INSERT INTO accounts ({columns}, last_update) VALUES %s
+    ON CONFLICT (account_number) DO UPDATE SET
+        {updates},
+        last_update = CURRENT_TIMESTAMP;
+""".format(
+    columns=", ".join(ACCOUNT_FIELDS),
+    updates=",\n        ".join(f"{field} = EXCLUDED.{field}" for field in ACCOUNT_FIELDS if field != "account_number")
+)
+ACCOUNT_UPSERT_TEMPLATE = "(" + ", ".join(["%s"] * len(ACCOUNT_FIELDS)) + ", CURRENT_TIMESTAMP)"
+
+def upsert_accounts(cur, rows):
+    # One row per account and a stable lock order keep concurrent flushes from deadlocking
+    rows = sorted(rows, key=lambda row: row[1])
+    psycopg2.extras.execute_values(cur, ACCOUNT_UPSERT_SQL, rows, template=ACCOUNT_UPSERT_TEMPLATE, page_size=max(len(rows), 1))
+
+class FleetRecord:
+    __slots__ = ("account", "updated_at")
+
+    def __init__(self, account, updated_at):
+        self.account = account
+        self.updated_at = updated_at
+
+def make_record(json_data, updated_at=None):
+    updated_at = updated_at or time.time()
+    account = {field: json_data[field] for field in ACCOUNT_FIELDS}
+    account["last_update"] = datetime.fromtimestamp(updated_at, pytz.UTC).isoformat()
+    account["seq"] = fleet.next_seq(account["account_number"], updated_at)
+    return FleetRecord(account, updated_at)
+
+class LiveFleet:
+    def __init__(self):
+        self._records = {}
+        self._seqs = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.version = 0
+        self.touched_at = 0
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def next_seq(self, account_number, updated_at):
+        # Microseconds since the epoch, so a restarted worker's warm start and next ingest stay above every seq
+        # already broadcast; the +1 keeps two records within one microsecond ordered
+        with self._lock:
+            seq = max(round(updated_at * 1000000), self._seqs.get(account_number, 0) + 1)
+            self._seqs[account_number] = seq
+            return seq
+
+    def put(self, records):
+        applied = []
+        with self._lock:
+            for record in records:
+                account_number = record.account["account_number"]
+                current = self._records.get(account_number)
+                if current is not None and current.updated_at >= record.updated_at:
+                    continue
+                self._seqs[account_number] = max(self._seqs.get(account_number, 0), record.account["seq"])
+                self._records[account_number] = record
+                applied.append(record)
+            if applied:
+                self.version += 1
+        if applied:
+            for listener in self._listeners:
+                listener(applied)
+        return applied
+
+    def touch(self, account, updated_at, timeout):
+        # True when the payload matches the live record; only its liveness moves forward, seq and version stay.
+        # A record near or past expiry takes the full upsert: the DB row lags memory by up to two liveness
+        # flushes and the leader may already have evicted it.
+        account_number = account["account_number"]
+        cutoff = updated_at - timeout * 60 + 2 * LIVENESS_FLUSH_SECONDS
+        with self._lock:
+            current = self._records.get(account_number)
+            if current is None or current.updated_at < cutoff:
+                return False
+            if any(current.account[field] != account[field] for field in ACCOUNT_FIELDS):
+                return False
+            if current.updated_at < updated_at:
+                self._records[account_number] = FleetRecord(
+                    dict(current.account, last_update=datetime.fromtimestamp(updated_at, pytz.UTC).isoformat()),
+                    updated_at
+                )
+                self.touched_at = max(self.touched_at, updated_at)
+        return True
+
+    def refresh(self, touched):
+        with self._lock:
+            for account_number, updated_at in touched:
+                current = self._records.get(account_number)
+                if current is not None and current.updated_at < updated_at:
+                    self._records[account_number] = FleetRecord(
+                        dict(current.account, last_update=datetime.fromtimestamp(updated_at, pytz.UTC).isoformat()),
+                        updated_at
+                    )
+                    self.touched_at = max(self.touched_at, updated_at)
+
+    def remove(self, account_numbers):
+        with self._lock:
+            removed = [self._records.pop(account_number) for account_number in account_numbers if account_number in self._records]
+            if removed:
+                self.version += 1
+        return removed
+
+    def prune(self, timeout):
+        cutoff = time.time() - timeout * 60
+        with self._lock:
+            expired = [account_number for account_number, record in self._records.items() if record.updated_at < cutoff]
+        return self.remove(expired)
+
+    def active_records(self, timeout):
+        cutoff = time.time() - timeout * 60
+        return [record for record in list(self._records.values()) if record.updated_at >= cutoff]
+
+    def active(self, timeout):
+        return [record.account for record in self.active_records(timeout)]
+
+    def active_count(self, timeout):
+        cutoff = time.time() - timeout * 60
+        return sum(1 for record in list(self._records.values()) if record.updated_at >= cutoff)
+
+    def liveness_epoch(self):
+        # Liveness-only refreshes change last_update but not version; they count once per flush window
+        return int(self.touched_at // LIVENESS_FLUSH_SECONDS)
+
+    def totals(self, timeout):
+        total_balance = total_equity = total_pl = all_time_pl = 0
+        for account in self.active(timeout):
+            total_balance += account["balance"] or 0
+            total_equity += account["equity"] or 0
+            total_pl += account["profit_loss"] or 0
+            if account["broker"] == 'Raw Trading Ltd':
+                all_time_pl += (account["realized_pl_alltime"] or 0) + fee(account["holding_fee_alltime"] or 0) + (account["swap_alltime"] or 0)
+            else:
+                all_time_pl += account["realized_pl_alltime"] or 0
+        return total_balance, total_equity, total_pl, all_time_pl
+
+    def load_from_db(self):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT {', '.join(ACCOUNT_FIELDS)}, EXTRACT(EPOCH FROM last_update) FROM accounts;")
+            rows = cur.fetchall()
+        records = [make_record(dict(zip(ACCOUNT_FIELDS, row)), float(row[-1])) for row in rows if row[-1] is not None]
+        applied = self.put(records)
+        logger.info(f"Live fleet loaded {len(applied)} of {len(records)} accounts from the database")
+
+    def stats(self):
+        return {"accounts": len(self._records), "version": self.version}
+
+fleet = LiveFleet()
+
+def publish_fleet_updates(cur, records):
+    payloads = []
+    for record in records:
+        payload = json.dumps({"origin": WORKER_ID, "updated_at": record.updated_at, "account": record.account}, default=str)
+        if len(payload) >= 8000:
+            logger.warning(f"Fleet update for account {record.account['account_number']} too large to publish")
+            continue
+        payloads.append(payload)
+    if payloads:
+        cur.execute("SELECT pg_notify('fleet_update', payload) FROM unnest(%s::text[]) AS payload;", (payloads,))
+
+def on_fleet_update(payload):
+    if payload is None:
+        fleet.load_from_db()
+        return
+    message = json.loads(payload)
+    if message["origin"] != WORKER_ID:
+        fleet.put([FleetRecord(message["account"], message["updated_at"])])
+
+notification_listener.subscribe("fleet_update", on_fleet_update)
+
+def write_accounts(records):
+    with db_connection() as conn, conn.cursor() as cur:
+        upsert_accounts(cur, [tuple(record.account[field] for field in ACCOUNT_FIELDS) for record in records])
+        publish_fleet_updates(cur, records)
+        conn.commit()
+
+class IngestBuffer:
+    def __init__(self, interval, max_pending):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ingest-buffer", daemon=True)
+        self._thread.start()
+
+    def add(self, record):
+        with self._lock:
+            self._pending[record.account["account_number"]] = record
+            self.received += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                write_accounts(list(batch.values()))
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                    for account_number, record in batch.items():
+                        self._pending.setdefault(account_number, record)
+                raise
+            with self._lock:
+                self.flushed += len(batch)
+                self.flushes += 1
+            return len(batch)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ingest Flush Error: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 5)
+        try:
+            count = self.flush()
+            logger.info(f"Ingest buffer flushed {count} accounts on shutdown")
+        except Exception as e:
+            logger.error(f"Ingest Shutdown Flush Error: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "received": self.received,
+                "flushed": self.flushed,
+                "flushes": self.flushes,
+                "failures": self.failures
+            }
+
+ingest_buffer = IngestBuffer(INGEST_FLUSH_INTERVAL, INGEST_FLUSH_SIZE) if INGEST_BUFFER_ENABLED else None
+
+class LivenessTouches:
+    # Unchanged posts are collapsed to one last_update per account per flush instead of a full-row upsert
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.touched = 0
+        self.flushes = 0
+
+    def add(self, account_numbers, updated_at):
+        with self._lock:
+            for account_number in account_numbers:
+                self._pending[account_number] = updated_at
+            self.skipped += len(account_numbers)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        rows = sorted(batch.items())
+        try:
+            with db_connection() as conn, conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    UPDATE accounts AS a SET last_update = to_timestamp(v.updated_at)
+                    FROM (VALUES %s) AS v(account_number, updated_at)
+                    WHERE a.account_number = v.account_number AND a.last_update < to_timestamp(v.updated_at);
+                """, rows, page_size=len(rows))
+                # Chunks stay under the 8000-byte NOTIFY payload limit
+                for start in range(0, len(rows), 200):
+                    payload = json.dumps({"origin": WORKER_ID, "touched": rows[start:start + 200]})
+                    cur.execute("SELECT pg_notify('fleet_touch', %s);", (payload,))
+                conn.commit()
+        except Exception:
+            with self._lock:
+                for account_number, updated_at in batch.items():
+                    self._pending.setdefault(account_number, updated_at)
+            raise
+        with self._lock:
+            self.touched += len(rows)
+            self.flushes += 1
+        return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._pending), "skipped": self.skipped, "touched": self.touched, "flushes": self.flushes}
+
+liveness_touches = LivenessTouches()
+
+def on_fleet_touch(payload):
+    if payload is None:
+        return
+    message = json.loads(payload)
+    if message["origin"] != WORKER_ID:
+        fleet.refresh(message["touched"])
+
+notification_listener.subscribe("fleet_touch", on_fleet_touch)
+
+def filter_unchanged(accounts, updated_at):
+    if not SKIP_UNCHANGED:
+        return accounts
+    timeout = get_account_timeout()
+    changed = []
+    unchanged = []
+    for account in accounts:
+        if fleet.touch(account, updated_at, timeout):
+            unchanged.append(account["account_number"])
+            INGEST_UNCHANGED.inc(account["broker"])
+        else:
+            changed.append(account)
+    if unchanged:
+        liveness_touches.add(unchanged, updated_at)
+    return changed
+
+def flush_liveness_touches():
+    try:
+        liveness_touches.flush()
+    except Exception as e:
+        logger.error(f"Liveness Touch Error: {e}")
 
-def clean_json_string(raw_data):
-    decoded = raw_data.decode("utf-8", errors="replace")
-    cleaned = re.sub(r'[^\x20-\x7E]', '', decoded)
-    return cleaned.strip()
+def to_float(value):
+    return value if type(value) is float or value is None else float(value)
+
+def to_int(value):
+    return value if type(value) is int or value is None else int(float(value))
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1")
+    return bool(value)
+
+def to_str(value):
+    return value if type(value) is str or value is None else str(value)
+
+ACCOUNT_INT_FIELDS = {"account_number", "open_charts", "empty_charts", "open_trades"}
+ACCOUNT_SCHEMA = tuple(
+    (field, to_str if field == "broker" else to_bool if field == "autotrading" else to_int if field in ACCOUNT_INT_FIELDS else to_float)
+    for field in ACCOUNT_FIELDS
+)
+
+# Compact ingest lines are "<version>|<value>|<value>|..." with values in the version's field order.
+# Versions are append-only: a new or reordered field list gets a new number, old ones keep working.
+ACCOUNT_SCHEMA_VERSION = 1
+COMPACT_SCHEMAS = {"1": ACCOUNT_SCHEMA}
+# Outbound records carry the ingest fields plus the server's last_update and seq
+ACCOUNT_WIRE_FIELDS = ACCOUNT_FIELDS + ["last_update", "seq"]
+ACCOUNT_WIRE_INDEX = {field: index for index, field in enumerate(ACCOUNT_WIRE_FIELDS)}
+
+def decode_account(json_data):
+    # Validates presence and coerces every field to its column type in one pass; returns (account, error)
+    if not isinstance(json_data, dict):
+        return None, "Payload must be a JSON object"
+    account = {}
+    field = None
+    try:
+        for field, coerce in ACCOUNT_SCHEMA:
+            account[field] = coerce(json_data[field])
+    except KeyError:
+        return None, f"Missing field: {field}"
+    except (TypeError, ValueError):
+        return None, f"Invalid value for {field}: {json_data[field]!r}"
+    if account["account_number"] is None or account["broker"] is None:
+        return None, "broker and account_number are required"
+    return account, None
+
+def decode_compact_account(line):
+    values = line.decode("ascii").split("|")
+    schema = COMPACT_SCHEMAS.get(values[0])
+    if schema is None:
+        return None, f"Unknown schema version: {values[0]}"
+    if len(values) - 1 != len(schema):
+        return None, f"Schema {values[0]} expects {len(schema)} fields, got {len(values) - 1}"
+    account = {}
+    field = value = None
+    try:
+        for (field, coerce), value in zip(schema, values[1:]):
+            account[field] = coerce(value) if value else None
+    except (TypeError, ValueError):
+        return None, f"Invalid value for {field}: {value!r}"
+    if account["account_number"] is None or account["broker"] is None:
+        return None, "broker and account_number are required"
+    return account, None
+
+def columnar_rows(accounts):
+    return [[account.get(field) for field in ACCOUNT_WIRE_FIELDS] for account in accounts]
+
+def parse_account_batch(raw_data):
+    stripped = raw_data.lstrip()
+    if stripped.startswith(b"["):
+        records = json_loads(clean_payload(raw_data))
+        if not isinstance(records, list):
+            raise ValueError("Batch payload must be a JSON array")
+        return [(record, None) for record in records]
+    parsed = []
+    for line in raw_data.splitlines():
+        line = clean_payload(line)
+        if not line:
+            continue
+        try:
+            parsed.append((json_loads(line), None))
+        except ValueError as e:
+            parsed.append((None, f"Invalid JSON: {e}"))
+    return parsed
+
+def store_accounts(records):
+    for record in records:
+        INGEST_ACCOUNTS.inc(record.account["broker"])
+    if ingest_buffer:
+        for record in records:
+            ingest_buffer.add(record)
+    else:
+        write_accounts(records)
+    fleet.put(records)
 
 @app.route("/api/mt4data", methods=["POST"])
 def receive_mt4_data():
     try:
-        raw_data = clean_json_string(request.data)
-        logger.debug(f"Raw Request Data: {raw_data}")
-        json_data = json.loads(raw_data)
-        required_fields = [
-            "broker", "account_number", "balance", "equity", "margin_used",
-            "free_margin", "margin_percent", "profit_loss", "realized_pl_daily",
-            "realized_pl_weekly", "realized_pl_monthly", "realized_pl_yearly",
-            "realized_pl_alltime", "deposits_alltime", "withdrawals_alltime",
-            "holding_fee_daily", "holding_fee_weekly", "holding_fee_monthly",
-            "holding_fee_yearly", "holding_fee_alltime", "open_charts",
-            "empty_charts", "open_trades", "autotrading", "swap_daily",
-            "swap_weekly", "swap_monthly", "swap_yearly", "swap_alltime",
-            "deposits_daily", "deposits_weekly", "deposits_monthly",
-            "deposits_yearly", "withdrawals_daily", "withdrawals_weekly",
-            "withdrawals_monthly", "withdrawals_yearly", "prev_day_pl",
-            "prev_day_holding_fee"
-        ]
-        for field in required_fields:
-            if field not in json_data:
-                logger.error(f"❌ Missing field: {field}")
-                return jsonify({"error": f"Missing field: {field}"}), 400
-        json_data["autotrading"] = json_data["autotrading"] == "true" or json_data["autotrading"] == True
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO accounts (
-                broker, account_number, balance, equity, margin_used, free_margin,
-                margin_percent, profit_loss, realized_pl_daily, realized_pl_weekly,
-                realized_pl_monthly, realized_pl_yearly, realized_pl_alltime,
-                deposits_alltime, withdrawals_alltime, holding_fee_daily,
-                holding_fee_weekly, holding_fee_monthly, holding_fee_yearly,
-                holding_fee_alltime, open_charts, empty_charts, open_trades,
-                autotrading, swap_daily, swap_weekly, swap_monthly, swap_yearly,
-                swap_alltime, deposits_daily, deposits_weekly, deposits_monthly,
-                deposits_yearly, withdrawals_daily, withdrawals_weekly,
-                withdrawals_monthly, withdrawals_yearly, prev_day_pl,
-                prev_day_holding_fee, last_update
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                      %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                      %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-            ON CONFLICT (account_number) DO UPDATE SET
-                broker = EXCLUDED.broker, balance = EXCLUDED.balance,
-                equity = EXCLUDED.equity, margin_used = EXCLUDED.margin_used,
-                free_margin = EXCLUDED.free_margin,
-                margin_percent = EXCLUDED.margin_percent,
-                profit_loss = EXCLUDED.profit_loss,
-                realized_pl_daily = EXCLUDED.realized_pl_daily,
-                realized_pl_weekly = EXCLUDED.realized_pl_weekly,
-                realized_pl_monthly = EXCLUDED.realized_pl_monthly,
-                realized_pl_yearly = EXCLUDED.realized_pl_yearly,
-                realized_pl_alltime = EXCLUDED.realized_pl_alltime,
-                deposits_alltime = EXCLUDED.deposits_alltime,
-                withdrawals_alltime = EXCLUDED.withdrawals_alltime,
-                holding_fee_daily = EXCLUDED.holding_fee_daily,
-                holding_fee_weekly = EXCLUDED.holding_fee_weekly,
-                holding_fee_monthly = EXCLUDED.holding_fee_monthly,
-                holding_fee_yearly = EXCLUDED.holding_fee_yearly,
-                holding_fee_alltime = EXCLUDED.holding_fee_alltime,
-                open_charts = EXCLUDED.open_charts,
-                empty_charts = EXCLUDED.empty_charts,
-                open_trades = EXCLUDED.open_trades,
-                autotrading = EXCLUDED.autotrading,
-                swap_daily = EXCLUDED.swap_daily,
-                swap_weekly = EXCLUDED.swap_weekly,
-                swap_monthly = EXCLUDED.swap_monthly,
-                swap_yearly = EXCLUDED.swap_yearly,
-                swap_alltime = EXCLUDED.swap_alltime,
-                deposits_daily = EXCLUDED.deposits_daily,
-                deposits_weekly = EXCLUDED.deposits_weekly,
-                deposits_monthly = EXCLUDED.deposits_monthly,
-                deposits_yearly = EXCLUDED.deposits_yearly,
-                withdrawals_daily = EXCLUDED.withdrawals_daily,
-                withdrawals_weekly = EXCLUDED.withdrawals_weekly,
-                withdrawals_monthly = EXCLUDED.withdrawals_monthly,
-                withdrawals_yearly = EXCLUDED.withdrawals_yearly,
-                prev_day_pl = EXCLUDED.prev_day_pl,
-                prev_day_holding_fee = EXCLUDED.prev_day_holding_fee,
-                last_update = CURRENT_TIMESTAMP;
-        """, tuple(json_data[field] for field in required_fields))
-        conn.commit()
-        cur.close()
-        conn.close()
-        logger.info(f"✅ Data stored for account {json_data['account_number']}")
-        json_data['last_update'] = datetime.now(pytz.UTC).isoformat()
-        socketio.emit('account_update', json_data)
-        check_alerts(json_data)
+        raw_data = clean_payload(request.data)
+        if RAW_BODY_LOG_RATE and random.random() < RAW_BODY_LOG_RATE:
+            logger.debug(f"Raw Request Data: {raw_data!r}")
+        try:
+            json_data = json_loads(raw_data)
+        except ValueError as e:
+            logger.error(f"❌ Invalid JSON: {e}")
+            return jsonify({"error": f"Invalid JSON: {e}"}), 400
+        account, error = decode_account(json_data)
+        if error:
+            logger.error(f"❌ {error}")
+            return jsonify({"error": error}), 400
+        updated_at = time.time()
+        if not filter_unchanged([account], updated_at):
+            return jsonify({"message": "Data unchanged", "unchanged": True}), 200
+        record = make_record(account, updated_at)
+        store_accounts([record])
+        logger.info(f"✅ Data stored for account {account['account_number']}")
         return jsonify({"message": "Data stored successfully"}), 200
     except Exception as e:
         logger.error(f"❌ API Processing Error: {str(e)}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
 
-def check_alerts(account_data):
-    conn = get_db_connection()
-    if not conn:
-        return
-    cur = conn.cursor()
+@app.route("/api/mt4data/batch", methods=["POST"])
+def receive_mt4_data_batch():
+    try:
+        try:
+            records = parse_account_batch(request.data)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid batch payload: {e}"}), 400
+        accounts = {}
+        errors = []
+        for index, (json_data, error) in enumerate(records):
+            account = None
+            if not error:
+                account, error = decode_account(json_data)
+            if error:
+                errors.append({"index": index, "error": error})
+                continue
+            accounts[account["account_number"]] = account
+        return store_batch(accounts, errors)
+    except Exception as e:
+        logger.error(f"❌ Batch Processing Error: {str(e)}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+
+def store_batch(accounts, errors):
+    if not accounts:
+        return jsonify({"error": "No valid records", "accepted": 0, "rejected": len(errors), "errors": errors}), 400
+    updated_at = time.time()
+    records = [make_record(account, updated_at) for account in filter_unchanged(list(accounts.values()), updated_at)]
+    if records:
+        store_accounts(records)
+    logger.info(f"✅ Batch stored for {len(records)} accounts ({len(accounts) - len(records)} unchanged, {len(errors)} rejected)")
+    return jsonify({
+        "message": "Batch stored successfully",
+        "accepted": len(accounts),
+        "unchanged": len(accounts) - len(records),
+        "rejected": len(errors),
+        "errors": errors
+    }), 200
+
+@app.route("/api/mt4data/compact", methods=["POST"])
+def receive_mt4_data_compact():
     try:
-        cur.execute("SELECT alert_thresholds, alerts_enabled FROM settings WHERE user_id = 'default';")
-        result = cur.fetchone()
-        thresholds = result[0] if result and result[0] else {"equity": 500, "profit_loss": -1000, "margin_percent": 20, "open_trades": 50}
-        alerts_enabled = result[1] if result else True
-        alerts = []
-        if alerts_enabled and account_data['open_trades'] > 0:
-            if account_data['equity'] < thresholds['equity']:
-                alerts.append({"account_number": account_data['account_number'], "issue": f"Low Equity: {account_data['equity']}", "severity": "critical"})
-            if account_data['profit_loss'] < thresholds['profit_loss']:
-                alerts.append({"account_number": account_data['account_number'], "issue": f"High Loss: {account_data['profit_loss']}", "severity": "warning"})
-            if account_data['margin_percent'] < thresholds['margin_percent']:
-                alerts.append({"account_number": account_number['account_number'], "issue": f"Low Margin: {account_data['margin_percent']}%", "severity": "critical"})
-            if account_data['open_trades'] > thresholds['open_trades']:
-                alerts.append({"account_number": account_data['account_number'], "issue": f"High Trade Volume: {account_data['open_trades']}", "severity": "warning"})
-            if not account_data['autotrading']:
-                alerts.append({"account_number": account_data['account_number'], "issue": "EA Stopped", "severity": "critical"})
-        if alerts:
-            socketio.emit('alert', alerts)
+        accounts = {}
+        errors = []
+        index = 0
+        for line in request.data.splitlines():
+            line = clean_payload(line)
+            if not line:
+                continue
+            account, error = decode_compact_account(line)
+            if error:
+                errors.append({"index": index, "error": error})
+            else:
+                accounts[account["account_number"]] = account
+            index += 1
+        return store_batch(accounts, errors)
+    except Exception as e:
+        logger.error(f"❌ Compact Processing Error: {str(e)}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.route("/api/schema/accounts", methods=["GET"])
+def get_account_schema():
+    return jsonify({
+        "version": ACCOUNT_SCHEMA_VERSION,
+        "compact_versions": {version: [field for field, _ in schema] for version, schema in COMPACT_SCHEMAS.items()},
+        "wire_fields": ACCOUNT_WIRE_FIELDS
+    })
+
+DEFAULT_ALERT_THRESHOLDS = {"equity": 500, "profit_loss": -1000, "margin_percent": 20, "open_trades": 50}
+# (rule, field, direction, severity, message); thresholds come from settings.alert_thresholds[field]
+ALERT_RULES = [
+    ("low_equity", "equity", "below", "critical", "Low Equity: {value}"),
+    ("high_loss", "profit_loss", "below", "warning", "High Loss: {value}"),
+    ("low_margin", "margin_percent", "below", "critical", "Low Margin: {value}%"),
+    ("high_trade_volume", "open_trades", "above", "warning", "High Trade Volume: {value}"),
+    ("ea_stopped", "autotrading", "off", "critical", "EA Stopped")
+]
+
+class AlertEngine:
+    # A rule raises when its threshold is crossed and only clears once the value is back past the
+    # threshold by the hysteresis band; a cleared rule cannot raise again until the cooldown expires.
+    # Every tick evaluates the whole live fleet, so a condition held back by the cooldown (or carried by
+    # unchanged posts that never reach fleet.put) raises as soon as the cooldown runs out.
+    def __init__(self, hysteresis, cooldown):
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self._states = {}
+        self._lock = threading.Lock()
+        self.evaluated = 0
+        self.raised = 0
+        self.cleared = 0
+
+    def forget(self, account_numbers):
+        account_numbers = set(account_numbers)
+        with self._lock:
+            for key in [key for key in self._states if key[0] in account_numbers]:
+                del self._states[key]
+
+    def active_alerts(self):
+        with self._lock:
+            return [state["alert"] for state in self._states.values() if state["active"]]
+
+    def _condition(self, direction, value, threshold, active):
+        if direction == "off":
+            return not value
+        band = abs(threshold) * self.hysteresis
+        if direction == "below":
+            return value < threshold + (band if active else 0)
+        return value > threshold - (band if active else 0)
+
+    def evaluate(self, accounts, thresholds, enabled):
+        raised = []
+        cleared = []
+        now = time.monotonic()
+        with self._lock:
+            for account in accounts:
+                account_number = account["account_number"]
+                for rule, field, direction, severity, message in ALERT_RULES:
+                    key = (account_number, rule)
+                    state = self._states.get(key)
+                    active = bool(state and state["active"])
+                    try:
+                        firing = enabled and (account["open_trades"] or 0) > 0 and self._condition(
+                            direction, account[field], thresholds.get(field, DEFAULT_ALERT_THRESHOLDS.get(field)), active
+                        )
+                    except TypeError:
+                        firing = False
+                    if firing and not active:
+                        if state and now - state["changed_at"] < self.cooldown:
+                            continue
+                        alert = {"account_number": account_number, "broker": account["broker"], "rule": rule, "issue": message.format(value=account[field]), "severity": severity}
+                        self._states[key] = {"active": True, "changed_at": now, "alert": alert}
+                        raised.append(alert)
+                    elif active and not firing:
+                        self._states[key] = {"active": False, "changed_at": now, "alert": None}
+                        cleared.append({"account_number": account_number, "broker": account["broker"], "rule": rule})
+            self.raised += len(raised)
+            self.cleared += len(cleared)
+        return raised, cleared
+
+    def tick(self):
+        settings = settings_cache.get()
+        accounts = fleet.active(get_account_timeout())
+        self.evaluated = len(accounts)
+        if not accounts:
+            return
+        thresholds = settings.get('alert_thresholds') or DEFAULT_ALERT_THRESHOLDS
+        raised, cleared = self.evaluate(accounts, thresholds, settings.get('alerts_enabled', True))
+        if raised:
+            emit_alerts('alert', raised)
+        if cleared:
+            emit_alerts('alert_cleared', cleared)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "evaluated": self.evaluated,
+                "active": sum(1 for state in self._states.values() if state["active"]),
+                "raised": self.raised,
+                "cleared": self.cleared
+            }
+
+alert_engine = AlertEngine(ALERT_HYSTERESIS, ALERT_COOLDOWN_SECONDS)
+
+def run_alert_engine():
+    try:
+        alert_engine.tick()
     except Exception as e:
         logger.error(f"Alert Check Error: {str(e)}")
-    finally:
-        cur.close()
-        conn.close()
+
+# Validators are built from per-worker counters, so they carry the worker id; a dashboard that lands on
+# another worker just gets a 200. They are read before the body is built, so a body is never older than its tag.
+def make_etag(*parts):
+    return "-".join(str(part) for part in (WORKER_ID[:12],) + parts)
+
+def fleet_etag(resource, timeout, *parts):
+    return make_etag(resource, fleet.version, settings_cache.generation, fleet.active_count(timeout), *parts)
+
+def not_modified(etag):
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(Response(status=304), etag)
+    return None
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.route("/api/accounts", methods=["GET"])
 def get_accounts():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        cur.execute("SELECT account_timeout FROM settings WHERE user_id = 'default';")
-        result = cur.fetchone()
-        timeout = result[0] if result else 2
-        cur.execute("""
-            SELECT * FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s;
-        """, (f"{timeout} minutes",))
-        rows = cur.fetchall()
-        columns = [desc[0] for desc in cur.description]
-        accounts = [dict(zip(columns, row)) for row in rows]
-        for account in accounts:
-            if account['last_update']:
-                account['last_update'] = account['last_update'].isoformat()
-        cur.close()
-        conn.close()
-        return jsonify({"accounts": accounts})
+        timeout = get_account_timeout()
+        etag = fleet_etag("accounts", timeout, fleet.liveness_epoch())
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        return with_etag(jsonify({"accounts": fleet.active(timeout)}), etag)
     except Exception as e:
         logger.error(f"API Fetch Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -311,219 +1692,168 @@ def get_accounts():
 @app.route("/api/quickstats", methods=["GET"])
 def get_quickstats():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        cur.execute("SELECT account_timeout FROM settings WHERE user_id = 'default';")
-        result = cur.fetchone()
-        timeout = result[0] if result else 2
-        cur.execute("""
-            SELECT SUM(balance) as total_balance,
-                   SUM(equity) as total_equity,
-                   SUM(profit_loss) as total_pl,
-                   SUM(CASE WHEN broker = 'Raw Trading Ltd'
-                            THEN realized_pl_alltime + (CASE WHEN holding_fee_alltime < 0 THEN holding_fee_alltime ELSE -holding_fee_alltime END) + swap_alltime
-                            ELSE realized_pl_alltime END) as all_time_pl
-            FROM accounts
-            WHERE last_update >= NOW() - INTERVAL %s;
-        """, (f"{timeout} minutes",))
-        stats = cur.fetchone()
-        total_balance = stats[0] or 0
-        total_equity = stats[1] or 0
-        total_pl = stats[2] or 0
-        all_time_pl = stats[3] or 0
+        timeout = get_account_timeout()
+        etag = fleet_etag("quickstats", timeout)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        total_balance, total_equity, total_pl, all_time_pl = fleet.totals(timeout)
         net_profit = (all_time_pl / (total_balance - all_time_pl)) * 100 if (total_balance - all_time_pl) != 0 else 0
-        cur.close()
-        conn.close()
-        return jsonify({
+        return with_etag(jsonify({
             "total_balance": total_balance,
             "total_equity": total_equity,
             "total_pl": total_pl,
             "net_profit": net_profit
-        })
+        }), etag)
     except Exception as e:
         logger.error(f"Quick Stats Fetch Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/analytics", methods=["GET"])
-def get_analytics():
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        cur.execute("SELECT account_timeout FROM settings WHERE user_id = 'default';")
-        result = cur.fetchone()
-        timeout = result[0] if result else 2
-        cur.execute("""
-            SELECT broker, 
-                   SUM(balance) as total_balance, 
-                   SUM(equity) as total_equity, 
-                   SUM(profit_loss) as total_pl, 
-                   SUM(open_trades) as total_trades,
-                   SUM(prev_day_pl) as prev_day_pl,
-                   SUM(realized_pl_daily) as realized_pl_daily,
-                   SUM(realized_pl_weekly) as realized_pl_weekly,
-                   SUM(realized_pl_monthly) as realized_pl_monthly,
-                   SUM(realized_pl_yearly) as realized_pl_yearly,
-                   SUM(realized_pl_alltime) as realized_pl_alltime,
-                   COUNT(DISTINCT account_number) as accounts_count
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            GROUP BY broker;
-        """, (f"{timeout} minutes",))
-        balance_data = [
+class TTLCache:
+    # Concurrent misses on the same key wait for a single computation instead of each running it
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            self.hits += 1
+            return entry[1]
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            value = compute()
+            self._entries[key] = (time.monotonic(), value)
+            self.misses += 1
+            return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+analytics_cache = TTLCache(ANALYTICS_CACHE_TTL)
+
+PERIODS = ["daily", "weekly", "monthly", "yearly", "alltime"]
+ANALYTICS_SUM_FIELDS = (
+    ["balance", "equity", "profit_loss", "open_trades", "prev_day_pl", "prev_day_holding_fee"]
+    + [f"realized_pl_{period}" for period in PERIODS]
+    + [f"holding_fee_{period}" for period in PERIODS]
+    + [f"swap_{period}" for period in PERIODS]
+    + [f"deposits_{period}" for period in PERIODS]
+    + [f"withdrawals_{period}" for period in PERIODS]
+)
+
+def fee(value):
+    return value if value < 0 else -value
+
+def top_accounts(accounts, field, limit=5):
+    ranked = heapq.nlargest(limit, (account for account in accounts if account[field] is not None), key=lambda account: account[field])
+    return [{"account_number": account["account_number"], "pl": account[field]} for account in ranked]
+
+def aggregate_accounts(accounts):
+    brokers = {}
+    margin_health = {"below_zero": 0, "zero_to_500": 0, "five_hundred_to_1000": 0, "above_1000": 0}
+    for account in accounts:
+        totals = brokers.get(account["broker"])
+        if totals is None:
+            totals = brokers[account["broker"]] = dict.fromkeys(ANALYTICS_SUM_FIELDS + ["fees_prev_day"] + [f"fees_{period}" for period in PERIODS], 0)
+            totals["accounts_count"] = 0
+        totals["accounts_count"] += 1
+        for field in ANALYTICS_SUM_FIELDS:
+            totals[field] += account[field] or 0
+        for period in PERIODS:
+            totals[f"fees_{period}"] += fee(account[f"holding_fee_{period}"] or 0) + (account[f"swap_{period}"] or 0)
+        totals["fees_prev_day"] += fee(account["prev_day_holding_fee"] or 0)
+        free_margin = account["free_margin"]
+        if free_margin is None:
+            continue
+        if free_margin < 0:
+            margin_health["below_zero"] += 1
+        elif free_margin <= 500:
+            margin_health["zero_to_500"] += 1
+        elif free_margin <= 1000:
+            margin_health["five_hundred_to_1000"] += 1
+        else:
+            margin_health["above_1000"] += 1
+    ordered = sorted(brokers.items())
+    return {
+        "balance_per_broker": [
             {
-                "broker": row[0], "balance": row[1], "equity": row[2], "profit_loss": row[3], 
-                "trades": row[4], "prev_day_pl": row[5], "realized_pl_daily": row[6], 
-                "realized_pl_weekly": row[7], "realized_pl_monthly": row[8], 
-                "realized_pl_yearly": row[9], "realized_pl_alltime": row[10],
-                "accountsCount": row[11]
-            } for row in cur.fetchall()
-        ]
-        cur.execute("""
-            SELECT broker, SUM(realized_pl_yearly) as yearly_pl 
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            GROUP BY broker;
-        """, (f"{timeout} minutes",))
-        yearly_pl_data = [{"broker": row[0], "yearly_pl": row[1]} for row in cur.fetchall()]
-        cur.execute("""
-            SELECT COUNT(*) FILTER (WHERE free_margin < 0) as below_zero,
-                   COUNT(*) FILTER (WHERE free_margin >= 0 AND free_margin <= 500) as zero_to_500,
-                   COUNT(*) FILTER (WHERE free_margin > 500 AND free_margin <= 1000) as five_hundred_to_1000,
-                   COUNT(*) FILTER (WHERE free_margin > 1000) as above_1000
-            FROM accounts
-            WHERE last_update >= NOW() - INTERVAL %s;
-        """, (f"{timeout} minutes",))
-        margin_health = cur.fetchone()
-        margin_health_data = {
-            "below_zero": margin_health[0], "zero_to_500": margin_health[1],
-            "five_hundred_to_1000": margin_health[2], "above_1000": margin_health[3]
-        }
-        cur.execute("""
-            SELECT account_number, realized_pl_daily 
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            ORDER BY realized_pl_daily DESC LIMIT 5;
-        """, (f"{timeout} minutes",))
-        top_daily = [{"account_number": row[0], "pl": row[1]} for row in cur.fetchall()]
-        cur.execute("""
-            SELECT account_number, realized_pl_monthly 
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            ORDER BY realized_pl_monthly DESC LIMIT 5;
-        """, (f"{timeout} minutes",))
-        top_monthly = [{"account_number": row[0], "pl": row[1]} for row in cur.fetchall()]
-        cur.execute("""
-            SELECT account_number, realized_pl_yearly 
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            ORDER BY realized_pl_yearly DESC LIMIT 5;
-        """, (f"{timeout} minutes",))
-        top_yearly = [{"account_number": row[0], "pl": row[1]} for row in cur.fetchall()]
-        cur.execute("""
-            SELECT broker, SUM(balance) as total_balance, SUM(equity) as total_equity
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            GROUP BY broker;
-        """, (f"{timeout} minutes",))
-        drawdown_data = [
-            {"broker": row[0], "drawdown": ((row[1] - row[2]) / row[1] * 100) if row[1] > 0 else 0} 
-            for row in cur.fetchall()
-        ]
-        cur.execute("""
-            SELECT DATE(snapshot_time AT TIME ZONE 'Asia/Beirut') as date, 
-                   SUM(profit_loss) as daily_pl
-            FROM history
-            WHERE snapshot_time >= (NOW() AT TIME ZONE 'Asia/Beirut' - INTERVAL '7 days')
-            GROUP BY DATE(snapshot_time AT TIME ZONE 'Asia/Beirut')
-            ORDER BY date ASC;
-        """)
-        floating_pl_data = [
-            {"date": row[0].strftime('%d/%m/%Y'), "daily_pl": row[1] or 0} 
-            for row in cur.fetchall()
+                "broker": broker, "balance": t["balance"], "equity": t["equity"], "profit_loss": t["profit_loss"],
+                "trades": t["open_trades"], "prev_day_pl": t["prev_day_pl"], "realized_pl_daily": t["realized_pl_daily"],
+                "realized_pl_weekly": t["realized_pl_weekly"], "realized_pl_monthly": t["realized_pl_monthly"],
+                "realized_pl_yearly": t["realized_pl_yearly"], "realized_pl_alltime": t["realized_pl_alltime"],
+                "accountsCount": t["accounts_count"]
+            } for broker, t in ordered
+        ],
+        "yearly_profits": [{"broker": broker, "yearly_pl": t["realized_pl_yearly"]} for broker, t in ordered],
+        "margin_health": margin_health,
+        "top_daily": top_accounts(accounts, "realized_pl_daily"),
+        "top_monthly": top_accounts(accounts, "realized_pl_monthly"),
+        "top_yearly": top_accounts(accounts, "realized_pl_yearly"),
+        "drawdown": [
+            {"broker": broker, "drawdown": ((t["balance"] - t["equity"]) / t["balance"] * 100) if t["balance"] > 0 else 0}
+            for broker, t in ordered
+        ],
+        "fees": [
+            {"broker": broker, "prev_day_holding": t["fees_prev_day"], "daily": t["fees_daily"], "weekly": t["fees_weekly"],
+             "monthly": t["fees_monthly"], "yearly": t["fees_yearly"], "alltime": t["fees_alltime"]}
+            for broker, t in ordered
+        ],
+        "deposits_withdrawals": [
+            dict(
+                {"broker": broker},
+                **{f"{period}_{kind}": t[f"{kind}_{period}"] for period in PERIODS for kind in ("deposits", "withdrawals")}
+            ) for broker, t in ordered
+        ],
+        "dw_balance": [
+            dict(
+                {"broker": broker},
+                **{f"{period}_balance": t[f"deposits_{period}"] + t[f"withdrawals_{period}"] for period in PERIODS}
+            ) for broker, t in ordered
         ]
+    }
+
+def compute_analytics(timeout):
+    accounts = fleet.active(timeout)
+    with db_connection() as conn, conn.cursor() as cur:
         cur.execute("""
-            SELECT DATE(snapshot_time AT TIME ZONE 'Asia/Beirut') as date, 
-                   SUM(open_trades) as daily_trades
-            FROM history
-            WHERE snapshot_time >= (NOW() AT TIME ZONE 'Asia/Beirut' - INTERVAL '7 days')
-            GROUP BY DATE(snapshot_time AT TIME ZONE 'Asia/Beirut')
-            ORDER BY date ASC;
+            SELECT day as date,
+                   SUM(profit_loss_sum) as daily_pl,
+                   SUM(open_trade_sum) as daily_trades
+            FROM history_daily
+            WHERE day >= DATE(NOW() AT TIME ZONE 'Asia/Beirut' - INTERVAL '7 days')
+            GROUP BY day
+            ORDER BY day ASC;
         """)
-        live_trades_data = [
-            {"date": row[0].strftime('%d/%m/%Y'), "daily_trades": row[1] or 0} 
-            for row in cur.fetchall()
-        ]
-        cur.execute("""
-            SELECT broker,
-                   SUM(CASE WHEN holding_fee_daily < 0 THEN holding_fee_daily ELSE -holding_fee_daily END + swap_daily) as daily_fees,
-                   SUM(CASE WHEN holding_fee_weekly < 0 THEN holding_fee_weekly ELSE -holding_fee_weekly END + swap_weekly) as weekly_fees,
-                   SUM(CASE WHEN holding_fee_monthly < 0 THEN holding_fee_monthly ELSE -holding_fee_monthly END + swap_monthly) as monthly_fees,
-                   SUM(CASE WHEN holding_fee_yearly < 0 THEN holding_fee_yearly ELSE -holding_fee_yearly END + swap_yearly) as yearly_fees,
-                   SUM(CASE WHEN holding_fee_alltime < 0 THEN holding_fee_alltime ELSE -holding_fee_alltime END + swap_alltime) as alltime_fees,
-                   SUM(CASE WHEN prev_day_holding_fee < 0 THEN prev_day_holding_fee ELSE -prev_day_holding_fee END) as prev_day_holding_fee
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            GROUP BY broker;
-        """, (f"{timeout} minutes",))
-        fees_data = [
-            {"broker": row[0], "prev_day_holding": row[5], "daily": row[0], "weekly": row[1], 
-             "monthly": row[2], "yearly": row[3], "alltime": row[4]} 
-            for row in cur.fetchall()
-        ]
-        cur.execute("""
-            SELECT broker,
-                   SUM(deposits_daily) as daily_deposits, SUM(withdrawals_daily) as daily_withdrawals,
-                   SUM(deposits_weekly) as weekly_deposits, SUM(withdrawals_weekly) as weekly_withdrawals,
-                   SUM(deposits_monthly) as monthly_deposits, SUM(withdrawals_monthly) as monthly_withdrawals,
-                   SUM(deposits_yearly) as yearly_deposits, SUM(withdrawals_yearly) as yearly_withdrawals,
-                   SUM(deposits_alltime) as alltime_deposits, SUM(withdrawals_alltime) as alltime_withdrawals
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            GROUP BY broker;
-        """, (f"{timeout} minutes",))
-        deposits_withdrawals_data = [
-            {"broker": row[0], "daily_deposits": row[1], "daily_withdrawals": row[2], 
-             "weekly_deposits": row[3], "weekly_withdrawals": row[4], "monthly_deposits": row[5], 
-             "monthly_withdrawals": row[6], "yearly_deposits": row[7], "yearly_withdrawals": row[8], 
-             "alltime_deposits": row[9], "alltime_withdrawals": row[10]} 
-            for row in cur.fetchall()
-        ]
-        cur.execute("""
-            SELECT broker,
-                   SUM(deposits_daily) + SUM(withdrawals_daily) as daily_balance,
-                   SUM(deposits_weekly) + SUM(withdrawals_weekly) as weekly_balance,
-                   SUM(deposits_monthly) + SUM(withdrawals_monthly) as monthly_balance,
-                   SUM(deposits_yearly) + SUM(withdrawals_yearly) as yearly_balance,
-                   SUM(deposits_alltime) + SUM(withdrawals_alltime) as alltime_balance
-            FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s
-            GROUP BY broker;
-        """, (f"{timeout} minutes",))
-        dw_balance_data = [
-            {"broker": row[0], "daily_balance": row[1] or 0, "weekly_balance": row[2] or 0, 
-             "monthly_balance": row[3] or 0, "yearly_balance": row[4] or 0, "alltime_balance": row[5] or 0} 
-            for row in cur.fetchall()
-        ]
-        cur.close()
-        conn.close()
-        return jsonify({
-            "balance_per_broker": balance_data,
-            "yearly_profits": yearly_pl_data,
-            "margin_health": margin_health_data,
-            "top_daily": top_daily,
-            "top_monthly": top_monthly,
-            "top_yearly": top_yearly,
-            "drawdown": drawdown_data,
-            "floating_pl": floating_pl_data,
-            "live_trades": live_trades_data,
-            "fees": fees_data,
-            "deposits_withdrawals": deposits_withdrawals_data,
-            "dw_balance": dw_balance_data
-        })
+        daily_rows = cur.fetchall()
+    analytics = aggregate_accounts(accounts)
+    analytics["floating_pl"] = [{"date": row[0].strftime('%d/%m/%Y'), "daily_pl": row[1] or 0} for row in daily_rows]
+    analytics["live_trades"] = [{"date": row[0].strftime('%d/%m/%Y'), "daily_trades": row[2] or 0} for row in daily_rows]
+    return analytics
+
+@app.route("/api/analytics", methods=["GET"])
+def get_analytics():
+    try:
+        timeout = get_account_timeout()
+        etag = fleet_etag("analytics", timeout, history_generation.value, datetime.now(BEIRUT_TZ).strftime("%Y%m%d"))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        # The cached body keeps the tag it was computed under, which may be older than the current one
+        body_etag, analytics = analytics_cache.get_or_compute(("analytics", timeout), lambda: (etag, compute_analytics(timeout)))
+        return with_etag(jsonify(analytics), body_etag)
     except Exception as e:
         logger.error(f"Analytics Fetch Error: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
@@ -531,27 +1861,13 @@ def get_analytics():
 @app.route("/api/settings", methods=["GET"])
 def get_settings():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT sort_state, is_numbers_masked, gmt_offset, period_resets,
-                   main_refresh_rate, critical_margin, warning_margin, is_dark_mode,
-                   mask_timer, font_size, notes, broker_offsets, alert_thresholds,
-                   alerts_enabled, sound_enabled, default_settings_timestamp, account_timeout, focus_group
-            FROM settings WHERE user_id = 'default';
-        """)
-        settings = cur.fetchone()
-        cur.close()
-        conn.close()
-        if settings:
-            columns = [desc[0] for desc in cur.description]
-            settings_dict = dict(zip(columns, settings))
-            if settings_dict['default_settings_timestamp']:
-                settings_dict['default_settings_timestamp'] = settings_dict['default_settings_timestamp'].isoformat()
-            return jsonify(settings_dict)
-        return jsonify({})
+        # Loaded first: a TTL reload may move the generation the tag is built from
+        settings = settings_cache.get()
+        etag = make_etag("settings", settings_cache.generation)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        return with_etag(jsonify(settings), etag)
     except Exception as e:
         logger.error(f"Settings Fetch Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -561,235 +1877,918 @@ def save_settings():
     try:
         settings = request.get_json()
         logger.info(f"Received settings: {settings}")
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO settings (
-                user_id, sort_state, is_numbers_masked, gmt_offset, period_resets,
-                main_refresh_rate, critical_margin, warning_margin, is_dark_mode,
-                mask_timer, font_size, notes, broker_offsets, alert_thresholds,
-                alerts_enabled, sound_enabled, default_settings_timestamp, account_timeout, focus_group
-            ) VALUES ('default', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE SET
-                sort_state = EXCLUDED.sort_state,
-                is_numbers_masked = EXCLUDED.is_numbers_masked,
-                gmt_offset = EXCLUDED.gmt_offset,
-                period_resets = EXCLUDED.period_resets,
-                main_refresh_rate = EXCLUDED.main_refresh_rate,
-                critical_margin = EXCLUDED.critical_margin,
-                warning_margin = EXCLUDED.warning_margin,
-                is_dark_mode = EXCLUDED.is_dark_mode,
-                mask_timer = EXCLUDED.mask_timer,
-                font_size = EXCLUDED.font_size,
-                notes = EXCLUDED.notes,
-                broker_offsets = EXCLUDED.broker_offsets,
-                alert_thresholds = EXCLUDED.alert_thresholds,
-                alerts_enabled = EXCLUDED.alerts_enabled,
-                sound_enabled = EXCLUDED.sound_enabled,
-                default_settings_timestamp = EXCLUDED.default_settings_timestamp,
-                account_timeout = EXCLUDED.account_timeout,
-                focus_group = EXCLUDED.focus_group;
-        """, (
-            json.dumps(settings.get('sort_state', {})),
-            settings.get('is_numbers_masked', False),
-            settings.get('gmt_offset', 3),
-            json.dumps(settings.get('period_resets', {})),
-            settings.get('main_refresh_rate', 5),
-            settings.get('critical_margin', 0),
-            settings.get('warning_margin', 500),
-            settings.get('is_dark_mode', True),
-            settings.get('mask_timer', 'never'),
-            settings.get('font_size', '14'),
-            json.dumps(settings.get('notes', {})),
-            json.dumps(settings.get('broker_offsets', {"Raw Trading Ltd": 3, "Swissquote": 5, "XTB International": -6})),
-            json.dumps(settings.get('alert_thresholds', {"equity": 500, "profit_loss": -1000, "margin_percent": 20, "open_trades": 50})),
-            settings.get('alerts_enabled', True),
-            settings.get('sound_enabled', False),
-            settings.get('default_settings_timestamp'),
-            settings.get('account_timeout', 2),
-            json.dumps(settings.get('focus_group', []))
-        ))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO settings (
+                    user_id, sort_state, is_numbers_masked, gmt_offset, period_resets,
+                    main_refresh_rate, critical_margin, warning_margin, is_dark_mode,
+                    mask_timer, font_size, notes, broker_offsets, alert_thresholds,
+                    alerts_enabled, sound_enabled, default_settings_timestamp, account_timeout, focus_group
+                ) VALUES ('default', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    sort_state = EXCLUDED.sort_state,
+                    is_numbers_masked = EXCLUDED.is_numbers_masked,
+                    gmt_offset = EXCLUDED.gmt_offset,
+                    period_resets = EXCLUDED.period_resets,
+                    main_refresh_rate = EXCLUDED.main_refresh_rate,
+                    critical_margin = EXCLUDED.critical_margin,
+                    warning_margin = EXCLUDED.warning_margin,
+                    is_dark_mode = EXCLUDED.is_dark_mode,
+                    mask_timer = EXCLUDED.mask_timer,
+                    font_size = EXCLUDED.font_size,
+                    notes = EXCLUDED.notes,
+                    broker_offsets = EXCLUDED.broker_offsets,
+                    alert_thresholds = EXCLUDED.alert_thresholds,
+                    alerts_enabled = EXCLUDED.alerts_enabled,
+                    sound_enabled = EXCLUDED.sound_enabled,
+                    default_settings_timestamp = EXCLUDED.default_settings_timestamp,
+                    account_timeout = EXCLUDED.account_timeout,
+                    focus_group = EXCLUDED.focus_group;
+            """, (
+                json.dumps(settings.get('sort_state', {})),
+                settings.get('is_numbers_masked', False),
+                settings.get('gmt_offset', 3),
+                json.dumps(settings.get('period_resets', {})),
+                settings.get('main_refresh_rate', 5),
+                settings.get('critical_margin', 0),
+                settings.get('warning_margin', 500),
+                settings.get('is_dark_mode', True),
+                settings.get('mask_timer', 'never'),
+                settings.get('font_size', '14'),
+                json.dumps(settings.get('notes', {})),
+                json.dumps(settings.get('broker_offsets', {"Raw Trading Ltd": 3, "Swissquote": 5, "XTB International": -6})),
+                json.dumps(settings.get('alert_thresholds', {"equity": 500, "profit_loss": -1000, "margin_percent": 20, "open_trades": 50})),
+                settings.get('alerts_enabled', True),
+                settings.get('sound_enabled', False),
+                settings.get('default_settings_timestamp'),
+                settings.get('account_timeout', 2),
+                json.dumps(settings.get('focus_group', []))
+            ))
+            cur.execute("NOTIFY settings_changed;")
+            conn.commit()
+        settings_cache.invalidate()
         logger.info("Settings saved successfully")
         return jsonify({"message": "Settings saved"}), 200
     except Exception as e:
         logger.error(f"Settings Save Error: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+BEIRUT_TZ = pytz.timezone('Asia/Beirut')
+
+HISTORY_INSERT_COLUMNS = [
+    "account_number", "balance", "equity", "margin_used", "free_margin", "margin_level",
+    "open_trade", "profit_loss", "open_charts", "deposit_withdrawal", "margin_percent",
+    "realized_pl_daily", "realized_pl_weekly", "realized_pl_monthly", "realized_pl_yearly",
+    "autotrading", "empty_charts", "deposits_alltime", "withdrawals_alltime",
+    "realized_pl_alltime", "holding_fee_daily", "broker", "traded_pairs",
+    "open_pairs_charts", "ea_names", "snapshot_time", "last_update"
+]
+HISTORY_SNAPSHOT_INDEX = HISTORY_INSERT_COLUMNS.index("snapshot_time")
+
+def parse_snapshot_times(values):
+    # Fleet uploads share one timestamp, so each distinct string is parsed once
+    parsed = {}
+    for value in {value for value in values if isinstance(value, str)}:
+        try:
+            snapshot_time = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            continue
+        if snapshot_time.tzinfo is None:
+            snapshot_time = snapshot_time.replace(tzinfo=pytz.UTC)
+        parsed[value] = snapshot_time.astimezone(BEIRUT_TZ)
+    return parsed
+
+def history_row(entry, snapshot_time):
+    return (
+        entry.get('account_number'),
+        entry.get('balance'),
+        entry.get('equity'),
+        entry.get('margin_used'),
+        entry.get('free_margin'),
+        entry.get('margin_percent', 0),
+        entry.get('open_trades', 0),
+        entry.get('profit_loss'),
+        entry.get('open_charts'),
+        0,
+        entry.get('margin_percent'),
+        entry.get('realized_pl_daily'),
+        entry.get('realized_pl_weekly'),
+        entry.get('realized_pl_monthly'),
+        entry.get('realized_pl_yearly'),
+        entry.get('autotrading'),
+        entry.get('empty_charts'),
+        entry.get('deposits_alltime'),
+        entry.get('withdrawals_alltime'),
+        entry.get('realized_pl_alltime'),
+        entry.get('holding_fee_daily'),
+        entry.get('broker'),
+        None,
+        None,
+        None,
+        snapshot_time,
+        snapshot_time
+    )
+
+HISTORY_DAILY_UPSERT_SQL = """
+    INSERT INTO history_daily (day, broker, account_number, profit_loss_sum, open_trade_sum, samples) VALUES %s
+    ON CONFLICT (day, broker, account_number) DO UPDATE SET
+        profit_loss_sum = history_daily.profit_loss_sum + EXCLUDED.profit_loss_sum,
+        open_trade_sum = history_daily.open_trade_sum + EXCLUDED.open_trade_sum,
+        samples = history_daily.samples + EXCLUDED.samples;
+"""
+
+def update_history_daily(cur, rows):
+    account_index = HISTORY_INSERT_COLUMNS.index("account_number")
+    broker_index = HISTORY_INSERT_COLUMNS.index("broker")
+    profit_index = HISTORY_INSERT_COLUMNS.index("profit_loss")
+    trades_index = HISTORY_INSERT_COLUMNS.index("open_trade")
+    time_index = HISTORY_INSERT_COLUMNS.index("snapshot_time")
+    totals = {}
+    for row in rows:
+        key = (row[time_index].astimezone(BEIRUT_TZ).date(), row[broker_index] or '', row[account_index])
+        total = totals.setdefault(key, [0, 0, 0])
+        total[0] += row[profit_index] or 0
+        total[1] += row[trades_index] or 0
+        total[2] += 1
+    if totals:
+        psycopg2.extras.execute_values(
+            cur, HISTORY_DAILY_UPSERT_SQL,
+            [key + tuple(total) for key, total in sorted(totals.items())],
+            page_size=len(totals)
+        )
+
+def backfill_history_daily():
+    # Rebuilds only the days raw history still covers; older rollup rows outlive their partitions
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT MIN(snapshot_time) FROM history;")
+        first = cur.fetchone()[0]
+        if first is None:
+            logger.info("History is empty, nothing to backfill")
+            return 0
+        first_day = first.astimezone(BEIRUT_TZ).date()
+        cur.execute("LOCK TABLE history_daily IN EXCLUSIVE MODE;")
+        cur.execute("DELETE FROM history_daily WHERE day >= %s;", (first_day,))
+        cur.execute("""
+            INSERT INTO history_daily (day, broker, account_number, profit_loss_sum, open_trade_sum, samples)
+            SELECT DATE(snapshot_time AT TIME ZONE 'Asia/Beirut'), COALESCE(broker, ''), account_number,
+                   COALESCE(SUM(profit_loss), 0), COALESCE(SUM(open_trade), 0), COUNT(*)
+            FROM history
+            WHERE account_number IS NOT NULL
+            GROUP BY 1, 2, 3;
+        """)
+        count = cur.rowcount
+        conn.commit()
+    logger.info(f"Backfilled {count} daily history rollups from {first_day}")
+    return count
+
+def insert_history(cur, rows):
+    if not rows:
+        return 0
+    psycopg2.extras.execute_values(cur, f"""
+        INSERT INTO history ({', '.join(HISTORY_INSERT_COLUMNS)}) VALUES %s
+        ON CONFLICT DO NOTHING
+    """, rows, page_size=len(rows))
+    inserted = cur.rowcount
+    mark_history_late(cur, rows)
+    return inserted
+
 @app.route("/api/history", methods=["POST"])
 def save_history():
     try:
         data = request.get_json()
         if not isinstance(data, list):
             data = [data]
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        for entry in data:
-            local_tz = pytz.timezone('Asia/Beirut')
-            snapshot_time = datetime.strptime(entry['timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=pytz.UTC)
-            beirut_time = snapshot_time.astimezone(local_tz)
-            cur.execute("""
-                INSERT INTO history (
-                    account_number, balance, equity, margin_used, free_margin, margin_level,
-                    open_trade, profit_loss, open_charts, deposit_withdrawal, margin_percent,
-                    realized_pl_daily, realized_pl_weekly, realized_pl_monthly, realized_pl_yearly,
-                    autotrading, empty_charts, deposits_alltime, withdrawals_alltime,
-                    realized_pl_alltime, holding_fee_daily, broker, traded_pairs,
-                    open_pairs_charts, ea_names, snapshot_time, last_update
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                          %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT DO NOTHING
-            """, (
-                entry.get('account_number'),
-                entry.get('balance'),
-                entry.get('equity'),
-                entry.get('margin_used'),
-                entry.get('free_margin'),
-                entry.get('margin_percent', 0),
-                entry.get('open_trades', 0),
-                entry.get('profit_loss'),
-                entry.get('open_charts'),
-                0,
-                entry.get('margin_percent'),
-                entry.get('realized_pl_daily'),
-                entry.get('realized_pl_weekly'),
-                entry.get('realized_pl_monthly'),
-                entry.get('realized_pl_yearly'),
-                entry.get('autotrading'),
-                entry.get('empty_charts'),
-                entry.get('deposits_alltime'),
-                entry.get('withdrawals_alltime'),
-                entry.get('realized_pl_alltime'),
-                entry.get('holding_fee_daily'),
-                entry.get('broker'),
-                None,
-                None,
-                None,
-                beirut_time,
-                beirut_time
-            ))
-        conn.commit()
-        cur.close()
-        conn.close()
-        logger.info(f"History saved for {len(data)} accounts")
-        return jsonify({"message": "History saved"}), 200
+        snapshot_times = parse_snapshot_times(entry.get('timestamp') for entry in data if isinstance(entry, dict))
+        rows = []
+        errors = []
+        for index, entry in enumerate(data):
+            if not isinstance(entry, dict):
+                errors.append({"index": index, "error": "Entry must be a JSON object"})
+            elif entry.get('account_number') is None:
+                errors.append({"index": index, "error": "Missing field: account_number"})
+            elif not isinstance(entry.get('timestamp'), str) or entry['timestamp'] not in snapshot_times:
+                errors.append({"index": index, "error": f"Invalid timestamp: {entry.get('timestamp')}"})
+            else:
+                rows.append(history_row(entry, snapshot_times[entry['timestamp']]))
+        with db_connection() as conn, conn.cursor() as cur:
+            inserted = insert_history(cur, rows)
+            update_history_daily(cur, rows)
+            cur.execute("NOTIFY history_changed;")
+            conn.commit()
+        logger.info(f"History saved for {inserted} accounts ({len(errors)} rejected)")
+        return jsonify({"message": "History saved", "inserted": inserted, "rejected": len(errors), "errors": errors}), 200
     except Exception as e:
         logger.error(f"History Save Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+HISTORY_COLUMNS = ["id"] + HISTORY_INSERT_COLUMNS
+HISTORY_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+def history_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def history_query(args):
+    fields = [field for field in args.get('fields', '').split(',') if field]
+    unknown = [field for field in fields if field not in HISTORY_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    # id and snapshot_time are the keyset, so they are always returned
+    columns = ["id", "snapshot_time"] + [field for field in fields if field not in ("id", "snapshot_time")] if fields else HISTORY_COLUMNS
+    query = f"SELECT {', '.join(columns)} FROM history WHERE 1=1"
+    params = []
+    if args.get('account'):
+        try:
+            params.append(int(args['account']))
+        except ValueError:
+            raise ValueError(f"Invalid account: {args['account']}")
+        query += " AND account_number = %s"
+    for arg, operator in (('start', '>='), ('end', '<=')):
+        if args.get(arg):
+            try:
+                params.append(parse_time_arg(args[arg], None))
+            except ValueError:
+                raise ValueError(f"Invalid {arg}: {args[arg]}")
+            query += f" AND snapshot_time {operator} %s"
+    if args.get('broker'):
+        query += " AND broker = %s"
+        params.append(args['broker'])
+    if args.get('after'):
+        after_time, _, after_id = args['after'].rpartition(',')
+        try:
+            after = [parse_time_arg(after_time, None), int(after_id)]
+        except ValueError:
+            after = [None]
+        if after[0] is None:
+            raise ValueError("after must be '<snapshot_time>,<id>'")
+        query += " AND (snapshot_time, id) > (%s, %s)"
+        params += after
+    query += " ORDER BY snapshot_time, id"
+    limit = args.get('limit')
+    if limit:
+        if int(limit) <= 0:
+            raise ValueError("limit must be positive")
+        query += " LIMIT %s"
+        params.append(int(limit))
+    return columns, query, params, int(limit) if limit else None
+
+def open_history_cursor(query, params):
+    # Checkout, execute and the first fetch happen before the response starts, so their failures still
+    # become a 4xx/5xx; the returned stack owns the connection and cursor for the rest of the stream
+    with ExitStack() as stack:
+        conn = stack.enter_context(db_connection())
+        cur = stack.enter_context(conn.cursor(name=f"history_{uuid.uuid4().hex}"))
+        cur.itersize = HISTORY_STREAM_CHUNK
+        cur.execute(query, params)
+        first = cur.fetchmany(HISTORY_STREAM_CHUNK)
+        return stack.pop_all(), cur, first
+
+def stream_history(stack, cur, first, columns, limit, fmt):
+    # Errors past this point cannot change the status any more; they are re-raised so the server aborts
+    # the chunked response instead of ending it as if it were complete
+    try:
+        with stack:
+            if fmt == "json":
+                yield '{"history": ['
+            elif fmt == "csv":
+                buffer = io.StringIO()
+                csv.writer(buffer).writerow(columns)
+                yield buffer.getvalue()
+            count = 0
+            last = None
+            chunk = []
+            for row in itertools.chain(first, cur):
+                values = [history_value(value) for value in row]
+                if fmt == "csv":
+                    chunk.append(values)
+                else:
+                    line = json.dumps(dict(zip(columns, values)))
+                    chunk.append(line if fmt == "ndjson" else ("," if count else "") + line)
+                count += 1
+                last = values
+                if len(chunk) >= HISTORY_STREAM_CHUNK:
+                    yield encode_history_chunk(chunk, fmt)
+                    chunk = []
+            if chunk:
+                yield encode_history_chunk(chunk, fmt)
+            if fmt == "json":
+                next_cursor = f"{last[columns.index('snapshot_time')]},{last[0]}" if limit and count == limit else None
+                yield f'], "next": {json.dumps(next_cursor)}}}'
+    except Exception as e:
+        logger.error(f"History Stream Error: {str(e)}", exc_info=True)
+        raise
+
+def encode_history_chunk(chunk, fmt):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(chunk)
+        return buffer.getvalue()
+    if fmt == "ndjson":
+        return "\n".join(chunk) + "\n"
+    return "".join(chunk)
+
 @app.route("/api/history", methods=["GET"])
 def get_history():
+    try:
+        fmt = request.args.get('format', 'json')
+        if fmt not in HISTORY_FORMATS:
+            return jsonify({"error": f"Unsupported format: {fmt}"}), 400
+        try:
+            columns, query, params, limit = history_query(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        stack, cur, first = open_history_cursor(query, params)
+        response = Response(
+            stream_with_context(stream_history(stack, cur, first, columns, limit, fmt)),
+            mimetype=HISTORY_FORMATS[fmt]
+        )
+        # Returns the connection even if the client goes away before the body is iterated
+        response.call_on_close(stack.close)
+        return response
+    except Exception as e:
+        logger.error(f"History Fetch Error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+SERIES_SOURCES = [("1d", 86400), ("1h", 3600), ("1m", 60)]
+SERIES_METRIC_ALIASES = {"open_trades": "open_trade"}
+
+def parse_time_arg(value, default):
+    if not value:
+        return default
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment if moment.tzinfo else moment.replace(tzinfo=pytz.UTC)
+
+def choose_series_source(start, width):
+    # Coarsest rollup that still resolves one bucket, falling back to rollups once raw rows have expired
+    raw_horizon = datetime.now(pytz.UTC) - timedelta(days=HISTORY_RAW_RETENTION_DAYS)
+    for resolution, seconds in SERIES_SOURCES:
+        if seconds <= width:
+            return resolution
+    if HISTORY_RAW_RETENTION_DAYS > 0 and start < raw_horizon:
+        return "1m"
+    return None
+
+def query_series(cur, key_column, key, metric, start, end, buckets, source):
+    width = max((end - start).total_seconds() / buckets, 1)
+    watermark = start
+    parts = []
+    if source:
+        cur.execute("SELECT COALESCE(late_since, rolled_until) FROM history_rollup_state WHERE resolution = %s;", (source,))
+        row = cur.fetchone()
+        watermark = max(start, min(end, row[0])) if row and row[0] else start
+        parts.append(f"""
+            SELECT account_number, bucket AS t, {metric}_min AS vmin, {metric}_max AS vmax,
+                   {metric}_sum AS vsum, samples AS n, {metric}_last AS vlast, last_time AS tlast
+            FROM history_{source}
+            WHERE {key_column} = %(key)s AND bucket >= %(start)s AND bucket < %(watermark)s
+        """)
+    parts.append(f"""
+        SELECT account_number, snapshot_time AS t, {metric} AS vmin, {metric} AS vmax,
+               {metric} AS vsum, 1 AS n, {metric} AS vlast, snapshot_time AS tlast
+        FROM history
+        WHERE {key_column} = %(key)s AND snapshot_time >= %(watermark)s AND snapshot_time <= %(end)s
+    """)
+    cur.execute(f"""
+        WITH source AS ({" UNION ALL ".join(parts)}),
+        per_account AS (
+            SELECT account_number, FLOOR(EXTRACT(EPOCH FROM t - %(start)s) / %(width)s)::BIGINT AS b,
+                   MIN(vmin) AS vmin, MAX(vmax) AS vmax, SUM(vsum) / NULLIF(SUM(n), 0) AS vavg,
+                   (array_agg(vlast ORDER BY tlast DESC))[1] AS vlast
+            FROM source
+            GROUP BY account_number, b
+        )
+        SELECT b, SUM(vmin), SUM(vmax), SUM(vavg), SUM(vlast)
+        FROM per_account
+        GROUP BY b
+        ORDER BY b;
+    """, {"key": key, "start": start, "end": end, "watermark": watermark, "width": width})
+    return width, [
+        {"t": (start + timedelta(seconds=b * width)).isoformat(), "min": vmin, "max": vmax, "avg": vavg, "last": vlast}
+        for b, vmin, vmax, vavg, vlast in cur.fetchall()
+    ]
+
+def lttb(points, threshold):
+    # Largest-Triangle-Three-Buckets over (x, y) pairs
+    if threshold >= len(points) or threshold < 3:
+        return points
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, len(points))
+        avg_x = sum(p[0] for p in points[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(p[1] for p in points[avg_start:avg_end]) / (avg_end - avg_start)
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        ax, ay = points[a]
+        best, best_area = range_start, -1
+        for j in range(range_start, range_end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+@app.route("/api/history/series", methods=["GET"])
+def get_history_series():
     try:
         account = request.args.get('account')
-        start = request.args.get('start')
-        end = request.args.get('end')
         broker = request.args.get('broker')
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
-        cur = conn.cursor()
-        query = "SELECT * FROM history WHERE 1=1"
-        params = []
-        if account:
-            query += " AND account_number = %s"
-            params.append(account)
-        if start:
-            query += " AND snapshot_time >= %s"
-            params.append(start)
-        if end:
-            query += " AND snapshot_time <= %s"
-            params.append(end)
-        if broker:
-            query += " AND broker = %s"
-            params.append(broker)
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        columns = [desc[0] for desc in cur.description]
-        history = [dict(zip(columns, row)) for row in rows]
-        for entry in history:
-            if entry['snapshot_time']:
-                entry['snapshot_time'] = entry['snapshot_time'].isoformat()
-            if entry['last_update']:
-                entry['last_update'] = entry['last_update'].isoformat()
-        cur.close()
-        conn.close()
-        return jsonify({"history": history})
+        metric = SERIES_METRIC_ALIASES.get(request.args.get('metric', 'equity'), request.args.get('metric', 'equity'))
+        mode = request.args.get('mode', 'buckets')
+        try:
+            if bool(account) == bool(broker):
+                raise ValueError("Pass exactly one of account or broker")
+            if metric not in ROLLUP_METRICS:
+                raise ValueError(f"Unsupported metric: {metric}")
+            if mode not in ("buckets", "lttb"):
+                raise ValueError(f"Unsupported mode: {mode}")
+            end = parse_time_arg(request.args.get('end'), datetime.now(pytz.UTC))
+            start = parse_time_arg(request.args.get('start'), end - timedelta(days=1))
+            points = min(int(request.args.get('points', 300)), SERIES_MAX_POINTS)
+            if start >= end or points <= 0:
+                raise ValueError("start must be before end and points must be positive")
+            key_column, key = ("account_number", int(account)) if account else ("broker", broker)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        # LTTB picks representative points from a finer bucketing
+        buckets = points * 4 if mode == "lttb" else points
+        source = choose_series_source(start, (end - start).total_seconds() / buckets)
+        with db_connection() as conn, conn.cursor() as cur:
+            width, series = query_series(cur, key_column, key, metric, start, end, buckets, source)
+        if mode == "lttb":
+            pairs = [(datetime.fromisoformat(point["t"]).timestamp(), point["avg"]) for point in series if point["avg"] is not None]
+            series = [
+                {"t": datetime.fromtimestamp(x, pytz.UTC).isoformat(), "value": y}
+                for x, y in lttb(pairs, points)
+            ]
+        return jsonify({
+            "metric": metric,
+            "account": account,
+            "broker": broker,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "bucket_seconds": width,
+            "source": f"history_{source}" if source else "history",
+            "mode": mode,
+            "points": series
+        })
     except Exception as e:
-        logger.error(f"History Fetch Error: {str(e)}")
+        logger.error(f"History Series Error: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_LATENCY.observe(time.perf_counter() - started, route, request.method, response.status_code)
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or not (response.mimetype == "application/json" or response.mimetype.startswith("text/"))):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    if brotli is not None and request.accept_encodings["br"]:
+        response.set_data(brotli.compress(body, quality=4))
+        response.headers["Content-Encoding"] = "br"
+    elif request.accept_encodings["gzip"]:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    for state, value in db_pool.stats().items():
+        POOL_CONNECTIONS.set(value, state)
+    FLEET_ACCOUNTS.set(fleet.stats()["accounts"])
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/health", methods=["GET"])
+def get_health():
+    return jsonify({
+        "status": "ok",
+        "pool": db_pool.stats(),
+        "settings_cache": settings_cache.stats(),
+        "analytics_cache": analytics_cache.stats(),
+        "fleet": fleet.stats(),
+        "alerts": alert_engine.stats(),
+        "worker_id": WORKER_ID,
+        "message_queue": bool(SOCKETIO_MESSAGE_QUEUE),
+        "ingest_buffer": ingest_buffer.stats() if ingest_buffer else None,
+        "liveness": liveness_touches.stats(),
+        "schema": schema_status,
+        "subscriptions": subscriptions.stats(),
+        "scheduler": scheduler_stats()
+    })
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({"error": "404 Not Found"}), 404
 
+# Delta protocol: every account carries a per-account seq (its update time in microseconds, so it keeps
+# rising across worker restarts). Full records (ingest emits, snapshots) apply
+# when their seq is newer than the client's copy. Delta entries carry base_seq, the seq of the last
+# broadcast they are relative to (0 means a full record); a client holding base_seq applies the entry,
+# one already at seq or newer ignores it, and anything else emits 'resync' for a fresh snapshot.
+class DeltaBroadcaster:
+    def __init__(self):
+        self._sent = {}
+        self._lock = threading.Lock()
+        self.ticks = 0
+
+    def build(self, accounts):
+        changed = []
+        current = {}
+        with self._lock:
+            for account in accounts:
+                account_number = account["account_number"]
+                current[account_number] = account
+                previous = self._sent.get(account_number)
+                if previous is None:
+                    changed.append(dict(account, base_seq=0))
+                elif previous["seq"] != account["seq"]:
+                    delta = {field: value for field, value in account.items() if previous.get(field) != value}
+                    delta["account_number"] = account_number
+                    delta["base_seq"] = previous["seq"]
+                    changed.append(delta)
+            removed = [account_number for account_number in self._sent if account_number not in current]
+            self._sent = current
+            self.ticks += 1
+        return changed, removed
+
+delta_broadcaster = DeltaBroadcaster()
+
+# Columnar frames index ACCOUNT_WIRE_FIELDS: snapshot/update rows are full records; delta "added" rows
+# are full records (base_seq 0) and "changed" rows are [account_number, base_seq, index, value, ...]
+def encode_snapshot(accounts, fmt):
+    if fmt == "columnar":
+        return {
+            "type": "snapshot",
+            "schema": ACCOUNT_SCHEMA_VERSION,
+            "fields": ACCOUNT_WIRE_FIELDS,
+            "rows": columnar_rows(accounts)
+        }
+    return {"type": "snapshot", "accounts": accounts}
+
+def encode_delta(changed, removed, fmt):
+    if fmt != "columnar":
+        return {"type": "delta", "accounts": changed, "removed": removed}
+    added = []
+    updated = []
+    for delta in changed:
+        if delta["base_seq"] == 0:
+            added.append(delta)
+            continue
+        row = [delta["account_number"], delta["base_seq"]]
+        for field, value in delta.items():
+            index = ACCOUNT_WIRE_INDEX.get(field)
+            if index is not None and field != "account_number":
+                row.extend((index, value))
+        updated.append(row)
+    return {
+        "type": "delta",
+        "schema": ACCOUNT_SCHEMA_VERSION,
+        "added": columnar_rows(added),
+        "changed": updated,
+        "removed": removed
+    }
+
+# Subscriptions: each client picks topics (everything, brokers, explicit accounts, and/or the saved
+# focus_group) and sits in one room per topic on its worker. Every worker receives every account
+# update (locally or via fleet_update), so it routes to its own rooms: accounts that reach the same set
+# of rooms share one payload, serialized once and sent to that room list, where each client gets it once.
+def topic_room(fmt, topic):
+    return f"{WORKER_ROOM}:{fmt}:{topic}"
+
+def focus_accounts():
+    focus = set()
+    for account_number in settings_cache.get().get('focus_group') or []:
+        try:
+            focus.add(int(account_number))
+        except (TypeError, ValueError):
+            continue
+    return focus
+
+def account_topics(account_number, broker, focus):
+    topics = ["all", f"broker:{broker}", f"account:{account_number}"]
+    if account_number in focus:
+        topics.append("focus")
+    return topics
+
+def subscription_topics(brokers=None, accounts=None, focus_group=False):
+    topics = {f"broker:{broker}" for broker in brokers or [] if broker}
+    for account_number in accounts or []:
+        try:
+            topics.add(f"account:{int(account_number)}")
+        except (TypeError, ValueError):
+            continue
+    if focus_group:
+        topics.add("focus")
+    return topics or {"all"}
+
+class Subscriptions:
+    def __init__(self):
+        self._clients = {}  # sid -> (format, topics)
+        self._members = {}  # room -> number of clients
+        self._lock = threading.Lock()
+
+    def set(self, sid, fmt, topics):
+        rooms = {topic_room(fmt, topic) for topic in topics}
+        with self._lock:
+            previous = self._clients.get(sid)
+            old_rooms = {topic_room(previous[0], topic) for topic in previous[1]} if previous else set()
+            self._clients[sid] = (fmt, topics)
+            for room in old_rooms - rooms:
+                self._leave(room)
+            for room in rooms - old_rooms:
+                self._members[room] = self._members.get(room, 0) + 1
+        return old_rooms - rooms, rooms - old_rooms
+
+    def drop(self, sid):
+        with self._lock:
+            previous = self._clients.pop(sid, None)
+            if previous:
+                for topic in previous[1]:
+                    self._leave(topic_room(previous[0], topic))
+        return previous
+
+    def _leave(self, room):
+        count = self._members.get(room, 0) - 1
+        if count > 0:
+            self._members[room] = count
+        else:
+            self._members.pop(room, None)
+
+    def get(self, sid):
+        return self._clients.get(sid, ("json", {"all"}))
+
+    def active_rooms(self):
+        with self._lock:
+            return set(self._members)
+
+    def stats(self):
+        with self._lock:
+            return {"clients": len(self._clients), "rooms": len(self._members)}
+
+subscriptions = Subscriptions()
+
+def route(entries, broker_of, formats=ACCOUNT_FORMATS):
+    # -> {(format, rooms): [entry, ...]} covering only rooms that have members on this worker
+    active = subscriptions.active_rooms()
+    if not active:
+        return {}
+    focus = focus_accounts()
+    groups = {}
+    for entry in entries:
+        account_number = entry["account_number"]
+        topics = account_topics(account_number, broker_of(entry), focus)
+        for fmt in formats:
+            rooms = tuple(room for room in (topic_room(fmt, topic) for topic in topics) if room in active)
+            if rooms:
+                groups.setdefault((fmt, rooms), []).append(entry)
+    return groups
+
+def encode_update(accounts, fmt):
+    if fmt == "columnar":
+        return {"type": "update", "schema": ACCOUNT_SCHEMA_VERSION, "rows": columnar_rows(accounts)}
+    return accounts[0] if len(accounts) == 1 else {"accounts": accounts}
+
+def emit_fleet_records(records):
+    try:
+        groups = route([record.account for record in records], lambda account: account["broker"])
+        for (fmt, rooms), accounts in groups.items():
+            socketio.emit('account_update', encode_update(accounts, fmt), to=list(rooms))
+    except Exception as e:
+        logger.error(f"Account Update Routing Error: {e}")
+
+fleet.subscribe(emit_fleet_records)
+
+def emit_alerts(event, alerts):
+    # Alerts are JSON in every format, so one route over both formats' rooms dedupes across them
+    groups = {}
+    for (fmt, rooms), entries in route(alerts, lambda alert: alert["broker"]).items():
+        for alert in entries:
+            groups.setdefault(id(alert), (alert, set()))[1].update(rooms)
+    by_rooms = {}
+    for alert, rooms in groups.values():
+        by_rooms.setdefault(tuple(sorted(rooms)), []).append(alert)
+    for rooms, entries in by_rooms.items():
+        socketio.emit(event, entries, to=list(rooms))
+
+def subscribed(topics, account_number, broker, focus):
+    return "all" in topics or not topics.isdisjoint(account_topics(account_number, broker, focus))
+
+def send_subscription_state(sid):
+    fmt, topics = subscriptions.get(sid)
+    focus = focus_accounts()
+    accounts = [account for account in fleet.active(get_account_timeout())
+                if subscribed(topics, account["account_number"], account["broker"], focus)]
+    emit('account_update', encode_snapshot(accounts, fmt))
+    alerts = [alert for alert in alert_engine.active_alerts()
+              if subscribed(topics, alert["account_number"], alert["broker"], focus)]
+    if alerts:
+        emit('alert', alerts)
+
+def apply_subscription(fmt, topics):
+    left, joined = subscriptions.set(request.sid, fmt, topics)
+    for room in left:
+        leave_room(room)
+    for room in joined:
+        join_room(room)
+
+def split_arg(name):
+    return [value for value in request.args.get(name, "").split(",") if value]
+
+# Deltas are tracked per worker, so each worker only streams them to the clients it holds
+@socketio.on('connect')
+def handle_connect():
+    fmt = request.args.get("format", "json")
+    if fmt not in ACCOUNT_FORMATS:
+        fmt = "json"
+    SOCKET_CLIENTS.inc(fmt)
+    apply_subscription(fmt, subscription_topics(
+        split_arg("brokers"), split_arg("accounts"), request.args.get("focus_group") in ("1", "true")
+    ))
+    send_subscription_state(request.sid)
+
+@socketio.on('subscribe')
+def handle_subscribe(data=None):
+    data = data if isinstance(data, dict) else {}
+    fmt, _ = subscriptions.get(request.sid)
+    apply_subscription(fmt, subscription_topics(data.get("brokers"), data.get("accounts"), bool(data.get("focus_group"))))
+    send_subscription_state(request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    previous = subscriptions.drop(request.sid)
+    SOCKET_CLIENTS.inc(previous[0] if previous else "json", value=-1)
+
+@socketio.on('resync')
+def handle_resync(data=None):
+    send_subscription_state(request.sid)
+
 scheduler = BackgroundScheduler()
 def emit_account_updates():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        cur = conn.cursor()
-        cur.execute("SELECT account_timeout FROM settings WHERE user_id = 'default';")
-        result = cur.fetchone()
-        timeout = result[0] if result else 2
-        cur.execute("""
-            SELECT * FROM accounts 
-            WHERE last_update >= NOW() - INTERVAL %s;
-        """, (f"{timeout} minutes",))
-        rows = cur.fetchall()
-        columns = [desc[0] for desc in cur.description]
-        accounts = [dict(zip(columns, row)) for row in rows]
-        for account in accounts:
-            if account['last_update']:
-                account['last_update'] = account['last_update'].isoformat()
-        socketio.emit('account_update', {"accounts": accounts})
-        cur.close()
-        conn.close()
+        accounts = fleet.active(get_account_timeout())
+        changed, removed = delta_broadcaster.build(accounts)
+        brokers = {account["account_number"]: account["broker"] for account in accounts}
+        for (fmt, rooms), entries in route(changed, lambda delta: brokers.get(delta["account_number"])).items():
+            socketio.emit('account_update', encode_delta(entries, [], fmt), to=list(rooms))
+        if removed:
+            # Brokers of removed accounts are gone with their records, so every subscribed room hears about them
+            active = subscriptions.active_rooms()
+            for fmt in ACCOUNT_FORMATS:
+                rooms = [room for room in active if room.startswith(topic_room(fmt, ""))]
+                if rooms:
+                    socketio.emit('account_update', encode_delta([], removed, fmt), to=rooms)
     except Exception as e:
         logger.error(f"Periodic Update Error: {e}")
 
 def cleanup_inactive_accounts():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        cur = conn.cursor()
-        cur.execute("SELECT account_timeout FROM settings WHERE user_id = 'default';")
-        result = cur.fetchone()
-        timeout = result[0] if result else 2
-        cur.execute("""
-            SELECT account_number, broker 
-            FROM accounts 
-            WHERE last_update < NOW() - INTERVAL %s;
-        """, (f"{timeout} minutes",))
-        inactive_accounts = cur.fetchall()
-        for account in inactive_accounts:
-            account_number, broker = account
-            cur.execute("DELETE FROM accounts WHERE account_number = %s;", (account_number,))
-            socketio.emit('account_removed', {
-                "account_number": account_number,
-                "broker": broker,
+        timeout = get_account_timeout()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                DELETE FROM accounts
+                WHERE last_update < NOW() - INTERVAL %s
+                RETURNING {', '.join(ACCOUNT_FIELDS)}, last_update;
+            """, (f"{timeout} minutes",))
+            evicted = [dict(zip(ACCOUNT_FIELDS + ["last_update"], row)) for row in cur.fetchall()]
+            if EVICTION_ARCHIVE and evicted:
+                rows = [history_row(account, account["last_update"]) for account in evicted]
+                insert_history(cur, rows)
+                update_history_daily(cur, rows)
+                cur.execute("NOTIFY history_changed;")
+            conn.commit()
+        if evicted:
+            socketio.emit('accounts_removed', {
+                "accounts": [{"account_number": account["account_number"], "broker": account["broker"]} for account in evicted],
                 "reason": "Inactivity timeout"
             })
-        conn.commit()
-        cur.close()
-        conn.close()
-        if inactive_accounts:
-            logger.info(f"Removed {len(inactive_accounts)} inactive accounts")
+            logger.info(f"Removed {len(evicted)} inactive accounts")
     except Exception as e:
         logger.error(f"Inactive Accounts Cleanup Error: {e}")
 
-scheduler.add_job(emit_account_updates, 'interval', seconds=5)
-scheduler.add_job(cleanup_inactive_accounts, 'interval', minutes=1)
-scheduler.start()
+def prune_fleet():
+    try:
+        alert_engine.forget(record.account["account_number"] for record in fleet.prune(get_account_timeout()))
+    except Exception as e:
+        logger.error(f"Fleet Prune Error: {e}")
+
+class LeaderElection:
+    # The leader holds a session advisory lock on its own connection. If the worker dies or the connection
+    # drops, Postgres releases the lock and the next worker to check takes over.
+    def __init__(self, dsn, lock_id):
+        self.dsn = dsn
+        self.lock_id = lock_id
+        self._conn = None
+        self.is_leader = False
+        self.elected = 0
+        self.since = None
+
+    def check(self):
+        try:
+            if self._conn is None or self._conn.closed:
+                self.is_leader = False
+                self._conn = psycopg2.connect(self.dsn, sslmode=DB_SSLMODE, keepalives=1, keepalives_idle=10,
+                                              keepalives_interval=5, keepalives_count=3)
+                self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with self._conn.cursor() as cur:
+                if self.is_leader:
+                    cur.execute("SELECT 1;")
+                else:
+                    cur.execute("SELECT pg_try_advisory_lock(%s);", (self.lock_id,))
+                    if cur.fetchone()[0]:
+                        self.is_leader = True
+                        self.elected += 1
+                        self.since = datetime.now(pytz.UTC).isoformat()
+                        logger.info(f"Worker {WORKER_ID} is now the scheduler leader")
+        except Exception as e:
+            if self.is_leader:
+                logger.error(f"Scheduler leader lost its lock connection: {e}")
+            else:
+                logger.error(f"Leader Election Error: {e}")
+            self.is_leader = False
+            self.close()
+        SCHEDULER_LEADER.set(1 if self.is_leader else 0)
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def stats(self):
+        return {"leader": self.is_leader, "since": self.since if self.is_leader else None, "elected": self.elected}
+
+leader_election = LeaderElection(DB_URL, SCHEDULER_LEADER_LOCK_ID)
+
+def leader_only(func):
+    def run():
+        if leader_election.is_leader:
+            return func()
+    run.__name__ = run.__qualname__ = func.__name__
+    return run
+
+def scheduler_stats():
+    jobs = {}
+    for job in scheduler.get_jobs():
+        stats = dict(job_runs.get(job.name, {}))
+        stats["next_run"] = job.next_run_time.isoformat() if job.next_run_time else None
+        jobs[job.name] = stats
+    return {"leader": leader_election.stats(), "jobs": jobs}
+
+def start_services():
+    # Per worker: each serves its own sockets and in-memory state
+    scheduler.add_job(timed_job(emit_account_updates), 'interval', seconds=5)
+    scheduler.add_job(timed_job(prune_fleet), 'interval', minutes=1)
+    scheduler.add_job(timed_job(db_pool.maintain), 'interval', seconds=30)
+    scheduler.add_job(timed_job(run_alert_engine), 'interval', seconds=ALERT_TICK_SECONDS)
+    scheduler.add_job(timed_job(flush_liveness_touches), 'interval', seconds=LIVENESS_FLUSH_SECONDS)
+    scheduler.add_job(leader_election.check, 'interval', seconds=LEADER_CHECK_SECONDS, next_run_time=datetime.now())
+    # Cluster-wide: only the elected leader runs these
+    scheduler.add_job(leader_only(timed_job(cleanup_inactive_accounts)), 'interval', minutes=1)
+    scheduler.add_job(leader_only(timed_job(maintain_history)), 'interval', minutes=HISTORY_MAINTENANCE_MINUTES)
+    scheduler.start()
+    atexit.register(leader_election.close)
+
+    check_schema()
+    db_pool.maintain()
+    try:
+        fleet.load_from_db()
+    except Exception as e:
+        logger.error(f"Live fleet warm start failed: {e}")
+    notification_listener.start()
+
+    if ingest_buffer:
+        ingest_buffer.start()
+        atexit.register(ingest_buffer.stop)
+    atexit.register(flush_liveness_touches)
 
-create_tables()
+# manage.py imports the app with MT4_SERVER_ROLE=cli to run one-off commands without the web services
+SERVER_ROLE = os.getenv("MT4_SERVER_ROLE", "web")
+if SERVER_ROLE == "web":
+    start_services()
 
 if __name__ == "__main__":
     socketio.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
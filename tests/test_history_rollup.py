@@ -0,0 +1,59 @@
+import os
+from datetime import datetime, timedelta
+
+os.environ.setdefault("MT4_SERVER_ROLE", "cli")
+
+import pytz
+
+import mt4_online_server as server
+
+class RecordingCursor:
+    # Serves the rollup state and records every statement; the rollup SQL itself needs Postgres
+    def __init__(self, state):
+        self.state = state
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((" ".join(sql.split()), params))
+
+    def fetchall(self):
+        return self.state
+
+    def saved(self):
+        return {params[0]: (params[1], params[2]) for sql, params in self.statements
+                if sql.startswith("INSERT INTO history_rollup_state")}
+
+    def deleted(self):
+        return [(sql.split()[2], params) for sql, params in self.statements if sql.startswith("DELETE FROM history_")]
+
+def test_late_rows_rebuild_their_buckets_at_every_level():
+    now = datetime.now(pytz.UTC)
+    rolled_1m = server.truncate_to(now - timedelta(minutes=2), "minute")
+    rolled_1h = server.truncate_to(rolled_1m, "hour")
+    rolled_1d = server.truncate_to(rolled_1h, "day")
+    late = server.truncate_to(now - timedelta(hours=3), "minute")
+    cur = RecordingCursor([("1m", rolled_1m, late), ("1h", rolled_1h, None), ("1d", rolled_1d, None)])
+
+    complete = server.rollup_history(cur)
+
+    assert cur.deleted()[0] == ("history_1m", (late, rolled_1m))
+    assert cur.deleted()[1] == ("history_1h", (server.truncate_to(late, "hour"), rolled_1h))
+    assert cur.saved()["1m"] == (rolled_1m, None)
+    assert cur.saved()["1h"] == (rolled_1h, None)
+    assert complete["1m"] == rolled_1m
+
+def test_a_long_re_roll_holds_back_the_next_level():
+    now = datetime.now(pytz.UTC)
+    rolled_1m = server.truncate_to(now - timedelta(minutes=2), "minute")
+    rolled_1h = server.truncate_to(rolled_1m, "hour")
+    rolled_1d = server.truncate_to(rolled_1h, "day")
+    late = server.truncate_to(now - timedelta(days=2), "hour")
+    cur = RecordingCursor([("1m", rolled_1m, late), ("1h", rolled_1h, None), ("1d", rolled_1d, None)])
+
+    complete = server.rollup_history(cur)
+
+    # One day of minutes per run; the 1h level waits for the rest before rebuilding past it
+    assert cur.saved()["1m"] == (rolled_1m, late + timedelta(days=1))
+    assert complete["1m"] == late + timedelta(days=1)
+    assert cur.deleted()[1] == ("history_1h", (late, late + timedelta(days=1)))
+    assert cur.saved()["1h"] == (rolled_1h, late + timedelta(days=1))
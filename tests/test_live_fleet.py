@@ -0,0 +1,36 @@
+import os
+import time
+
+os.environ.setdefault("MT4_SERVER_ROLE", "cli")
+
+import mt4_online_server as server
+
+def account(account_number, **values):
+    record = {field: 0.0 for field in server.ACCOUNT_FIELDS}
+    record.update(broker="X", account_number=account_number, open_trades=0, open_charts=0, empty_charts=0, autotrading=True)
+    record.update(values)
+    return record
+
+def test_seq_keeps_rising_across_a_worker_restart(monkeypatch):
+    surviving = server.LiveFleet()
+    monkeypatch.setattr(server, "fleet", surviving)
+    for profit in range(10):
+        surviving.put([server.make_record(account(1, profit_loss=float(profit)))])
+    served = surviving.active(60)[0]["seq"]
+
+    # The restarted worker warm-starts from the accounts row, then ingests the next update
+    restarted = server.LiveFleet()
+    monkeypatch.setattr(server, "fleet", restarted)
+    restarted.put([server.make_record(account(1, profit_loss=9.0), time.time())])
+    assert restarted.active(60)[0]["seq"] >= served
+    update = server.make_record(account(1, profit_loss=10.0))
+
+    assert surviving.put([update]) == [update]
+    assert surviving.active(60)[0]["seq"] > served
+
+def test_records_within_one_microsecond_still_get_increasing_seqs(monkeypatch):
+    monkeypatch.setattr(server, "fleet", server.LiveFleet())
+    now = time.time()
+    first = server.make_record(account(1), now)
+    second = server.make_record(account(1, profit_loss=1.0), now)
+    assert second.account["seq"] == first.account["seq"] + 1
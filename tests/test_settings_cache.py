@@ -0,0 +1,40 @@
+import os
+from contextlib import nullcontext
+
+os.environ.setdefault("MT4_SERVER_ROLE", "cli")
+
+import mt4_online_server as server
+
+class SettingsConnection:
+    def __init__(self, row):
+        self.row = row
+
+    def cursor(self):
+        return nullcontext(self)
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+def settings_row(**values):
+    row = dict.fromkeys(server.SETTINGS_COLUMNS)
+    row.update(values)
+    return tuple(row[column] for column in server.SETTINGS_COLUMNS)
+
+def test_ttl_reload_with_new_settings_changes_the_settings_etag(monkeypatch):
+    connection = SettingsConnection(settings_row(account_timeout=2))
+    monkeypatch.setattr(server, "db_connection", lambda: nullcontext(connection))
+    monkeypatch.setattr(server, "settings_cache", server.SettingsCache(ttl=0))
+    client = server.app.test_client()
+
+    first = client.get("/api/settings")
+    assert client.get("/api/settings", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    # The settings_changed NOTIFY was missed; only the TTL reload sees the new row
+    connection.row = settings_row(account_timeout=5)
+    changed = client.get("/api/settings", headers={"If-None-Match": first.headers["ETag"]})
+    assert changed.status_code == 200
+    assert changed.get_json()["account_timeout"] == 5
+    assert changed.headers["ETag"] != first.headers["ETag"]
@@ -0,0 +1,190 @@
+# Cross-worker Socket.IO delivery. Each "worker" is a separate import of the server module, the way gunicorn
+# runs them, configured through SOCKETIO_MESSAGE_QUEUE; the Redis behind it is an in-process fakeredis server.
+import importlib.util
+import json
+import os
+import time
+from contextlib import nullcontext
+
+os.environ.setdefault("MT4_SERVER_ROLE", "cli")
+
+import fakeredis
+import flask_socketio.test_client
+import pytest
+import redis
+
+import mt4_online_server as server
+
+QUEUE_CHANNEL = "mt4-test"
+
+class StubCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+class StubConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return StubCursor(self.rows)
+
+    def commit(self):
+        pass
+
+@pytest.fixture
+def queue_workers(monkeypatch):
+    redis_server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=redis_server)))
+    monkeypatch.setenv("SOCKETIO_MESSAGE_QUEUE", "redis://queue.test:6379/0")
+    monkeypatch.setenv("SOCKETIO_CHANNEL", QUEUE_CHANNEL)
+    # The test client refuses a message queue because remote emits arrive asynchronously; tests poll for them
+    monkeypatch.setattr(flask_socketio.test_client, "PubSubManager", type("NoMessageQueue", (), {}))
+
+    def load(name):
+        spec = importlib.util.spec_from_file_location(name, server.__file__)
+        worker = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(worker)
+        monkeypatch.setattr(worker.settings_cache, "get", lambda: {"account_timeout": 2, "focus_group": []})
+        # The test client initializes the manager and so does the server on its first connection; a second
+        # queue listener would deliver every remote emit twice
+        manager = worker.socketio.server.manager
+        initialize = manager.initialize
+        started = []
+        monkeypatch.setattr(manager, "initialize", lambda: started or (started.append(True), initialize()))
+        return worker
+
+    def listening(count, timeout=5):
+        # A publish reaches only workers whose queue listener has already subscribed
+        probe = fakeredis.FakeRedis(server=redis_server)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if dict(probe.pubsub_numsub(QUEUE_CHANNEL)).get(QUEUE_CHANNEL.encode(), 0) >= count:
+                return
+            time.sleep(0.01)
+        raise AssertionError(f"{count} queue listeners did not subscribe")
+
+    return load("mt4_worker_a"), load("mt4_worker_b"), listening
+
+def evict(worker, monkeypatch, *accounts):
+    rows = [tuple(entry[field] for field in server.ACCOUNT_FIELDS) + (None,) for entry in accounts]
+    monkeypatch.setattr(worker, "db_connection", lambda: nullcontext(StubConnection(rows)))
+    worker.cleanup_inactive_accounts()
+
+def collect(client, event, timeout=5):
+    # Every message up to and including the first `event`
+    messages = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        messages += client.get_received()
+        if any(message["name"] == event for message in messages):
+            return messages
+        time.sleep(0.01)
+    raise AssertionError(f"no {event} within {timeout}s, got {[message['name'] for message in messages]}")
+
+def test_eviction_on_one_worker_reaches_dashboards_of_another(queue_workers, monkeypatch):
+    worker_a, worker_b, listening = queue_workers
+    dashboard = worker_b.socketio.test_client(worker_b.app)
+    dashboard.get_received()
+    listening(1)
+
+    evict(worker_a, monkeypatch, account(1, "X"))
+
+    removed = [message["args"][0] for message in collect(dashboard, "accounts_removed") if message["name"] == "accounts_removed"]
+    assert removed == [{"accounts": [{"account_number": 1, "broker": "X"}], "reason": "Inactivity timeout"}]
+
+def test_subscription_rooms_stay_on_their_worker(queue_workers, monkeypatch):
+    # Every worker routes fleet updates to its own dashboards, so one worker's room emits must not reach
+    # another worker's clients subscribed to the same topic, or they would get each update twice
+    worker_a, worker_b, listening = queue_workers
+    local = worker_a.socketio.test_client(worker_a.app, query_string="brokers=X")
+    remote = worker_b.socketio.test_client(worker_b.app, query_string="brokers=X")
+    local.get_received()
+    remote.get_received()
+    listening(2)
+
+    worker_a.fleet.put([worker_a.make_record(account(1, "X"))])
+    # The queue keeps order, so once the broadcast arrives the room emit before it has been handled too
+    evict(worker_a, monkeypatch, account(2, "Y"))
+
+    assert [message["args"][0]["account_number"] for message in local.get_received() if message["name"] == "account_update"] == [1]
+    assert [message["name"] for message in collect(remote, "accounts_removed")] == ["accounts_removed"]
+
+def account(account_number, broker, **values):
+    record = {field: 0.0 for field in server.ACCOUNT_FIELDS}
+    record.update(broker=broker, account_number=account_number, open_trades=0, open_charts=0, empty_charts=0, autotrading=True)
+    record.update(values)
+    return record
+
+@pytest.fixture
+def live_worker(monkeypatch):
+    # Settings normally come from Postgres; pin them so no database is needed
+    monkeypatch.setattr(server.settings_cache, "get", lambda: {"account_timeout": 2, "focus_group": [3]})
+    monkeypatch.setattr(server, "fleet", server.LiveFleet())
+    monkeypatch.setattr(server, "subscriptions", server.Subscriptions())
+    monkeypatch.setattr(server, "delta_broadcaster", server.DeltaBroadcaster())
+    server.fleet.subscribe(server.emit_fleet_records)
+    clients = []
+
+    def connect(query=""):
+        client = server.socketio.test_client(server.app, query_string=query)
+        client.get_received()
+        clients.append(client)
+        return client
+    yield connect
+    for client in clients:
+        client.disconnect()
+
+def updated_accounts(client):
+    accounts = []
+    for message in client.get_received():
+        if message["name"] != "account_update":
+            continue
+        data = message["args"][0]
+        accounts += [entry["account_number"] for entry in data.get("accounts", [data])] if "type" not in data else \
+            [entry["account_number"] for entry in data["accounts"]]
+    return sorted(accounts)
+
+def test_update_from_another_worker_is_routed_to_subscribed_rooms_only(live_worker):
+    everyone = live_worker()
+    broker_x = live_worker("brokers=X")
+    focus = live_worker("focus_group=1")
+    explicit = live_worker("accounts=2")
+
+    # Another worker ingested these; this one learns about them through NOTIFY fleet_update
+    now = time.time()
+    for number, broker in ((1, "X"), (2, "Y"), (3, "Z")):
+        server.on_fleet_update(json.dumps({
+            "origin": "another-worker",
+            "updated_at": now,
+            "account": dict(account(number, broker), seq=1, last_update="")
+        }))
+
+    assert updated_accounts(everyone) == [1, 2, 3]
+    assert updated_accounts(broker_x) == [1]
+    assert updated_accounts(focus) == [3]
+    assert updated_accounts(explicit) == [2]
+
+def test_overlapping_subscriptions_receive_each_update_once(live_worker):
+    client = live_worker("brokers=X&accounts=1")
+    server.fleet.put([server.make_record(account(1, "X"))])
+    assert updated_accounts(client) == [1]
+
+def test_periodic_deltas_follow_subscriptions(live_worker):
+    broker_y = live_worker("brokers=Y")
+    server.fleet.put([server.make_record(account(1, "X")), server.make_record(account(2, "Y"))])
+    broker_y.get_received()
+    server.emit_account_updates()
+    deltas = [message["args"][0] for message in broker_y.get_received() if message["name"] == "account_update"]
+    assert [entry["account_number"] for delta in deltas for entry in delta["accounts"]] == [2]